@@ -5,6 +5,7 @@ from http import HTTPStatus
 from uuid import UUID
 
 from pydantic import BaseModel
+from sqlalchemy import case, literal, or_
 from werkzeug.security import check_password_hash, generate_password_hash
 
 import app.models.db_models as data
@@ -38,24 +39,23 @@ class Role(BaseModel):
         return cls(id=db_role.id, name=db_role.name)
 
 
-class UserInfo(BaseModel):
-    user_id: UserID
-    email: str | None
-    phone: str | None
-    username: str
-    time_zone: str = "UTC"
-    reject_notice: list[str]
-
-    @classmethod
-    def from_db(cls, db_user: data.User):
-        return cls(
-            user_id=db_user.id,
-            email=db_user.email,
-            phone=db_user.phone,
-            username=db_user.username,
-            time_zone=db_user.time_zone,
-            reject_notice=db_user.reject_notice or [],
-        )
+# поле ответа /userinfo -> колонка таблицы users
+USER_INFO_COLUMNS = {
+    "user_id": data.User.id,
+    "email": data.User.email,
+    "phone": data.User.phone,
+    "username": data.User.username,
+    "time_zone": data.User.time_zone,
+    "reject_notice": data.User.reject_notice,
+}
+# поля с контактами, наличие которых можно потребовать в users_info
+CONTACT_FIELDS = ("email", "phone")
+# аудитории рассылок: все пользователи или пользователи с ролью, "role:<name>"
+AUDIENCE_ALL = "all"
+AUDIENCE_ROLE_PREFIX = "role:"
+# причины, по которым пользователь не получит сообщение
+REJECTED_USER = "user"  # отписался от этого типа рассылок
+REJECTED_NODATA = "nodata"  # нет нужного контакта
 
 
 class User(BaseModel):
@@ -172,7 +172,17 @@ class AbstractUsers(ABC):
         pass
 
     @abstractmethod
-    def users_info(self, user_ids: list[UserID]) -> list[UserInfo]:
+    def users_info(
+        self,
+        user_ids: list[UserID],
+        fields: list[str] | None = None,
+        msg_type: str | None = None,
+        contact: str | None = None,
+    ) -> tuple[list[dict], dict[str, list[UserID]]]:
+        pass
+
+    @abstractmethod
+    def audience_page(self, audience: str, after: UserID | None = None, limit: int = 1000) -> list[UserID]:
         pass
 
 
@@ -346,9 +356,61 @@ class Users(AbstractUsers):
 
         return User.from_db(db_user)
 
-    def users_info(self, user_ids: list[UserID]) -> list[UserInfo]:
-        db_users = data.User.query.filter(data.User.id.in_(user_ids))
-        return [UserInfo.from_db(db_user) for db_user in db_users]
+    def users_info(
+        self,
+        user_ids: list[UserID],
+        fields: list[str] | None = None,
+        msg_type: str | None = None,
+        contact: str | None = None,
+    ) -> tuple[list[dict], dict[str, list[UserID]]]:
+        """
+        Данные пользователей, которым можно отправить сообщение, и id остальных по причинам отказа.
+        Выбираются только колонки fields (по умолчанию все), без загрузки пользователей и их ролей целиком.
+        msg_type - отбросить отписавшихся от этого типа рассылок, contact - отбросить тех, у кого нет контакта
+        """
+        fields = ["user_id", *(name for name in fields or USER_INFO_COLUMNS if name != "user_id")]
+        columns = [USER_INFO_COLUMNS[name] for name in fields]
+
+        # причину отказа считает база, отказавшие отдаются только списком id
+        whens = []
+        if msg_type is not None:
+            whens.append((data.User.reject_notice.contains([msg_type]), REJECTED_USER))
+        if contact is not None:
+            column = USER_INFO_COLUMNS[contact]
+            whens.append((or_(column.is_(None), column == ""), REJECTED_NODATA))
+        reason = case(*whens, else_=None) if whens else literal(None)
+
+        rows = data.db.session.query(*columns, reason.label("reason")).filter(data.User.id.in_(user_ids))
+        users = []
+        rejected = {}
+        for *values, reason in rows:
+            if reason is not None:
+                rejected.setdefault(reason, []).append(values[0])
+                continue
+            user_info = dict(zip(fields, values))
+            if "reject_notice" in user_info:
+                user_info["reject_notice"] = user_info["reject_notice"] or []
+            if "time_zone" in user_info:
+                user_info["time_zone"] = user_info["time_zone"] or "UTC"
+            users.append(user_info)
+        return users, rejected
+
+    def audience_page(self, audience: str, after: UserID | None = None, limit: int = 1000) -> list[UserID]:
+        """
+        Страница id пользователей аудитории по возрастанию id, начиная после after (keyset-пагинация).
+        Следующую страницу запрашивают с after = последний id страницы
+        """
+        query = data.db.session.query(data.User.id)
+        if audience.startswith(AUDIENCE_ROLE_PREFIX):
+            role_name = audience.removeprefix(AUDIENCE_ROLE_PREFIX)
+            query = (
+                query.join(data.user_roles, data.user_roles.c.user_id == data.User.id)
+                .join(data.Role, data.Role.id == data.user_roles.c.role_id)
+                .filter(data.Role.name == role_name)
+            )
+        if after is not None:
+            query = query.filter(data.User.id > after)
+        return [user_id for user_id, in query.order_by(data.User.id).limit(limit)]
 
 
 class Roles(AbstractRoles):
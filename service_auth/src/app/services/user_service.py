@@ -48,5 +48,11 @@ def logout_all(user_id: UUID):
     auth_srv.close_all_user_sessions(user_id)
 
 
-def get_users_info(user_ids: list[UUID]):
-    return [userinfo.dict() for userinfo in users.users_info(user_ids)]
+def get_users_info(
+    user_ids: list[UUID], fields: list[str] | None = None, msg_type: str | None = None, contact: str | None = None
+) -> tuple[list[dict], dict[str, list[UUID]]]:
+    return users.users_info(user_ids, fields, msg_type, contact)
+
+
+def get_audience_page(audience: str, after: UUID | None, limit: int) -> list[UUID]:
+    return users.audience_page(audience, after, limit)
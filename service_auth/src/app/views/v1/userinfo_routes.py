@@ -3,6 +3,7 @@ from http import HTTPStatus
 from flask import Blueprint, jsonify, request
 
 from app.core.utils import error, validate_uuids, secret_key_required
+from app.db.database import AUDIENCE_ALL, AUDIENCE_ROLE_PREFIX, CONTACT_FIELDS, USER_INFO_COLUMNS
 from app.services import user_service
 from config import flask_config
 
@@ -24,6 +25,52 @@ def get_users_info():
 
     validate_uuids(*user_ids)
 
-    users_info = user_service.get_users_info(user_ids)
-    response = jsonify(users_info=users_info)
+    # можно запросить только нужные поля, по умолчанию отдаются все
+    fields = request.json.get("fields", None)
+    if fields is not None:
+        if not isinstance(fields, list) or not all(isinstance(name, str) for name in fields):
+            return error("Fields must be provided as list of names", HTTPStatus.BAD_REQUEST)
+        if unknown := set(fields) - USER_INFO_COLUMNS.keys():
+            return error(f"Unknown fields: {', '.join(sorted(unknown))}", HTTPStatus.BAD_REQUEST)
+
+    # фильтры доставки: отписавшиеся от msg_type и пользователи без контакта contact
+    # в users_info не попадают, их id отдаются в rejected по причинам
+    msg_type = request.json.get("msg_type", None)
+    if msg_type is not None and not isinstance(msg_type, str):
+        return error("msg_type must be a string", HTTPStatus.BAD_REQUEST)
+
+    contact = request.json.get("contact", None)
+    if contact is not None and contact not in CONTACT_FIELDS:
+        return error(f"contact must be one of: {', '.join(CONTACT_FIELDS)}", HTTPStatus.BAD_REQUEST)
+
+    users_info, rejected = user_service.get_users_info(user_ids, fields, msg_type, contact)
+    response = jsonify(users_info=users_info, rejected=rejected)
     return response
+
+
+# самая большая страница аудитории
+AUDIENCE_MAX_LIMIT = 10000
+
+
+@userinfo_bp.post("/audience")
+@secret_key_required(secret_key)
+def get_audience():
+    """
+    id пользователей аудитории ("all" или "role:<name>") страницами по limit штук.
+    after - последний id предыдущей страницы, next - after для следующей страницы или null в конце
+    """
+    audience = request.json.get("audience", None)
+    if not isinstance(audience, str) or not (audience == AUDIENCE_ALL or audience.startswith(AUDIENCE_ROLE_PREFIX)):
+        return error(f"audience must be {AUDIENCE_ALL} or {AUDIENCE_ROLE_PREFIX}<name>", HTTPStatus.BAD_REQUEST)
+
+    after = request.json.get("after", None)
+    if after is not None:
+        validate_uuids(after)
+
+    limit = request.json.get("limit", 1000)
+    if not isinstance(limit, int) or not 0 < limit <= AUDIENCE_MAX_LIMIT:
+        return error(f"limit must be from 1 to {AUDIENCE_MAX_LIMIT}", HTTPStatus.BAD_REQUEST)
+
+    user_ids = user_service.get_audience_page(audience, after, limit)
+    next_after = user_ids[-1] if len(user_ids) == limit else None
+    return jsonify(user_ids=user_ids, next=next_after)
@@ -0,0 +1,198 @@
+from http import HTTPStatus
+
+import pytest
+
+from app.flask_db import db
+from app.models.db_models import User
+from config import flask_config
+
+
+@pytest.fixture
+def auth_by_secret_key():
+    return {"Authorization": flask_config.SECRET_KEY}
+
+
+@pytest.fixture
+def all_user_ids(client):
+    return sorted(str(user_id) for user_id, in db.session.query(User.id))
+
+
+@pytest.fixture
+def promo_rejected_user_id(client):
+    # example_with_roles отписался от рассылок promo и указал телефон
+    user = User.find_by_email("example_with_roles")
+    user.reject_notice = ["promo"]
+    user.phone = "+70000000000"
+    db.session.commit()
+    return str(user.id)
+
+
+@pytest.mark.parametrize("url", ["auth/v1/userinfo", "auth/v1/audience"])
+def test_secret_key_required(url, client):
+    response = client.post(url, json={}, headers={"Authorization": "invalid_secret_key"})
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_users_info(client, auth_by_secret_key, example_user_id):
+    response = client.post("auth/v1/userinfo", json={"user_ids": [example_user_id]}, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json["rejected"] == {}
+    users_info = response.json["users_info"]
+    assert len(users_info) == 1
+    assert set(users_info[0]) == {"user_id", "email", "phone", "username", "time_zone", "reject_notice"}
+    assert users_info[0]["user_id"] == example_user_id
+    assert users_info[0]["email"] == "example"
+    assert users_info[0]["time_zone"] == "UTC"
+    assert users_info[0]["reject_notice"] == []
+
+
+def test_users_info_fields(client, auth_by_secret_key, example_user_id):
+    body = {"user_ids": [example_user_id], "fields": ["email", "time_zone"]}
+    response = client.post("auth/v1/userinfo", json=body, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    # user_id отдается всегда
+    assert response.json["users_info"] == [{"user_id": example_user_id, "email": "example", "time_zone": "UTC"}]
+
+
+def test_users_info_unknown_user(client, auth_by_secret_key, non_exist_uuid):
+    response = client.post("auth/v1/userinfo", json={"user_ids": [non_exist_uuid]}, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == {"users_info": [], "rejected": {}}
+
+
+def test_users_info_rejected_by_user(client, auth_by_secret_key, example_user_id, promo_rejected_user_id):
+    body = {"user_ids": [example_user_id, promo_rejected_user_id], "fields": ["email"], "msg_type": "promo"}
+    response = client.post("auth/v1/userinfo", json=body, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json["users_info"] == [{"user_id": example_user_id, "email": "example"}]
+    assert response.json["rejected"] == {"user": [promo_rejected_user_id]}
+
+
+def test_users_info_rejected_by_nodata(client, auth_by_secret_key, example_user_id, promo_rejected_user_id):
+    # у example нет телефона
+    body = {"user_ids": [example_user_id, promo_rejected_user_id], "fields": ["phone"], "contact": "phone"}
+    response = client.post("auth/v1/userinfo", json=body, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json["users_info"] == [{"user_id": promo_rejected_user_id, "phone": "+70000000000"}]
+    assert response.json["rejected"] == {"nodata": [example_user_id]}
+
+
+def test_users_info_rejected_by_user_first(client, auth_by_secret_key, example_user_id, promo_rejected_user_id):
+    # отписка важнее отсутствия контакта
+    body = {"user_ids": [example_user_id, promo_rejected_user_id], "msg_type": "promo", "contact": "email"}
+    user = User.find_by_email("example_with_roles")
+    user.email = ""
+    db.session.commit()
+
+    response = client.post("auth/v1/userinfo", json=body, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert [user_info["user_id"] for user_info in response.json["users_info"]] == [example_user_id]
+    assert response.json["rejected"] == {"user": [promo_rejected_user_id]}
+
+
+@pytest.mark.parametrize(
+    "body, status_code",
+    [
+        ({}, HTTPStatus.BAD_REQUEST),
+        ({"user_ids": "7f32cd4a-7981-436d-bba7-78169acbbb5d"}, HTTPStatus.BAD_REQUEST),
+        ({"user_ids": ["not_uuid"]}, HTTPStatus.UNPROCESSABLE_ENTITY),
+        ({"user_ids": [], "fields": "email"}, HTTPStatus.BAD_REQUEST),
+        ({"user_ids": [], "fields": ["email", "password_hash"]}, HTTPStatus.BAD_REQUEST),
+        ({"user_ids": [], "msg_type": ["promo"]}, HTTPStatus.BAD_REQUEST),
+        ({"user_ids": [], "contact": "username"}, HTTPStatus.BAD_REQUEST),
+    ],
+)
+def test_users_info_validation(body, status_code, client, auth_by_secret_key):
+    response = client.post("auth/v1/userinfo", json=body, headers=auth_by_secret_key)
+    assert response.status_code == status_code
+
+
+def test_users_info_unknown_fields_message(client, auth_by_secret_key):
+    body = {"user_ids": [], "fields": ["password_hash", "email", "is_root"]}
+    response = client.post("auth/v1/userinfo", json=body, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json["msg"] == "Unknown fields: is_root, password_hash"
+
+
+def test_audience_all(client, auth_by_secret_key, all_user_ids):
+    response = client.post("auth/v1/audience", json={"audience": "all"}, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == {"user_ids": all_user_ids, "next": None}
+
+
+def test_audience_role(client, auth_by_secret_key, example_with_roles_user_id):
+    body = {"audience": "role:subscriber"}
+    response = client.post("auth/v1/audience", json=body, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == {"user_ids": [example_with_roles_user_id], "next": None}
+
+
+def test_audience_unknown_role(client, auth_by_secret_key):
+    response = client.post("auth/v1/audience", json={"audience": "role:unknown"}, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == {"user_ids": [], "next": None}
+
+
+@pytest.mark.parametrize("audience", ["all", "role:admin"])
+def test_audience_paging(audience, client, auth_by_secret_key):
+    user_ids = []
+    pages = 0
+    body = {"audience": audience, "limit": 1}
+    while True:
+        response = client.post("auth/v1/audience", json=body, headers=auth_by_secret_key)
+        assert response.status_code == HTTPStatus.OK
+        pages += 1
+        user_ids.extend(response.json["user_ids"])
+        if response.json["next"] is None:
+            break
+        # полная страница, next - ее последний id
+        assert response.json["next"] == response.json["user_ids"][-1]
+        body["after"] = response.json["next"]
+
+    expected = client.post("auth/v1/audience", json={"audience": audience}, headers=auth_by_secret_key).json
+    assert user_ids == expected["user_ids"]
+    assert user_ids == sorted(user_ids)
+    # последняя страница пустая: число пользователей делится на limit=1
+    assert pages == len(user_ids) + 1
+
+
+def test_audience_last_page(client, auth_by_secret_key, all_user_ids):
+    body = {"audience": "all", "limit": 2}
+    response = client.post("auth/v1/audience", json=body, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == {"user_ids": all_user_ids[:2], "next": all_user_ids[1]}
+
+    body["after"] = response.json["next"]
+    response = client.post("auth/v1/audience", json=body, headers=auth_by_secret_key)
+
+    assert response.status_code == HTTPStatus.OK
+    # неполная страница - последняя
+    assert response.json == {"user_ids": all_user_ids[2:], "next": None}
+
+
+@pytest.mark.parametrize(
+    "body, status_code",
+    [
+        ({}, HTTPStatus.BAD_REQUEST),
+        ({"audience": "admin"}, HTTPStatus.BAD_REQUEST),
+        ({"audience": ["all"]}, HTTPStatus.BAD_REQUEST),
+        ({"audience": "all", "after": "not_uuid"}, HTTPStatus.UNPROCESSABLE_ENTITY),
+        ({"audience": "all", "limit": 0}, HTTPStatus.BAD_REQUEST),
+        ({"audience": "all", "limit": 10001}, HTTPStatus.BAD_REQUEST),
+        ({"audience": "all", "limit": "10"}, HTTPStatus.BAD_REQUEST),
+    ],
+)
+def test_audience_validation(body, status_code, client, auth_by_secret_key):
+    response = client.post("auth/v1/audience", json=body, headers=auth_by_secret_key)
+    assert response.status_code == status_code
@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-18 12:00
+
+import notifications.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("notifications", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="audience",
+            field=models.CharField(
+                blank=True,
+                help_text='Instead of recipients: "all" or "role:<name>", users are taken from auth when sending',
+                max_length=254,
+                null=True,
+                validators=[notifications.validators.validate_audience],
+                verbose_name="Audience",
+            ),
+        ),
+    ]
@@ -1,10 +1,11 @@
 import uuid
 
 from django.contrib.postgres.fields import ArrayField
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
-from .validators import validate_uuid, validate_datetime
+from .validators import validate_audience, validate_uuid, validate_datetime
 
 
 class UUIDTimeStampedMixin(models.Model):
@@ -62,6 +63,9 @@ class Notification(UUIDTimeStampedMixin, models.Model):
         models.CharField(max_length=255), validators=[validate_uuid], blank=True, null=True, default=list,
         help_text=_('Recipients UUIDs. For example: 74f4c5ff-2432-4594-ae49-2f9f48f274ed,'
                     ' 2b2a5654-7dd3-4ea4-ae19-0d9a4a7999ba'), verbose_name=_('Recipients'))
+    audience = models.CharField(
+        _('Audience'), max_length=254, validators=[validate_audience], blank=True, null=True,
+        help_text=_('Instead of recipients: "all" or "role:<name>", users are taken from auth when sending'))
     template = models.ForeignKey(Template, on_delete=models.PROTECT, verbose_name=_('Template'))
     transport = models.CharField(
         _('Method of sending'), max_length=50,
@@ -88,3 +92,8 @@ class Notification(UUIDTimeStampedMixin, models.Model):
 
     def __str__(self):
         return self.name
+
+    def clean(self):
+        # получатели - либо списком, либо аудиторией. формат аудитории проверяет validate_audience
+        if bool(self.users_ids) == bool(self.audience):
+            raise ValidationError(_('Set either recipients or audience, exactly one of them'))
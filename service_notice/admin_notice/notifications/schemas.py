@@ -1,9 +1,9 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from types import NoneType
 from typing import List
 from uuid import UUID
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, root_validator, validator
 
 import orjson
 
@@ -22,10 +22,32 @@ class BaseModelMixin(BaseModel):
 class Message(BaseModelMixin):
     x_request_id: str | NoneType
     notice_id: UUID
-    users_id: List[UUID]
+    users_id: List[UUID] = Field(default_factory=list)
+    audience: str | NoneType = None
     template_id: UUID | NoneType = 1
     extra: dict = Field(default_factory=dict)
     transport: str
     priority: int | NoneType = 0
     msg_type: str | NoneType
     expire_at: datetime
+
+    @validator("expire_at")
+    def validate_expire_at(cls, date):
+        # если дата без часового пояса - это UTC, так же ее понимает ETL
+        if not date.tzinfo:
+            return date.replace(tzinfo=timezone.utc)
+        return date
+
+    @validator("audience")
+    def validate_audience(cls, value):
+        # "all" или "role:<name>", остальное auth не примет
+        if value is not None and value != "all" and not (value.startswith("role:") and len(value) > len("role:")):
+            raise ValueError('audience must be "all" or "role:<name>"')
+        return value
+
+    @root_validator(skip_on_failure=True)
+    def validate_recipients(cls, values):
+        # получатели - либо списком, либо аудиторией
+        if bool(values.get("users_id")) == bool(values.get("audience")):
+            raise ValueError("exactly one of users_id or audience must be set")
+        return values
@@ -22,6 +22,7 @@ def generate_message_for_sending(notification):
     message = Message(x_request_id=str(uuid.uuid4()),
                       notice_id=notification.id,
                       users_id=users,
+                      audience=notification.audience or None,
                       template_id=notification.template_id,
                       extra={},
                       transport=notification.transport,
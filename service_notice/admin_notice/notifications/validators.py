@@ -16,6 +16,14 @@ def validate_uuid(user_ids):
             )
 
 
+def validate_audience(audience):
+    if audience != 'all' and not (audience.startswith('role:') and len(audience) > len('role:')):
+        raise ValidationError(
+            _('%(audience)s is not an audience. Use "all" or "role:<name>"'),
+            params={'audience': audience},
+        )
+
+
 def validate_datetime(time):
     if time.strftime('%Y-%m-%dT%H:%M') < timezone.now().strftime('%Y-%m-%dT%H:%M'):
         raise ValidationError(
@@ -1,13 +1,16 @@
 import logging
-import json
+import time
 from abc import abstractmethod, ABC
-from fastapi.encoders import jsonable_encoder
 import backoff as backoff
 from aio_pika import connect, Message
 from aiormq import AMQPConnectionError
 
+from src import codec
 from src.settings import settings
 
+# срок жизни рассылки (unix time, сек): ETL выбрасывает просроченные рассылки, не разбирая тело
+EXPIRE_HEADER = "x-expire-at"
+
 
 class BaseProducer(ABC):
     @abstractmethod
@@ -44,11 +47,15 @@ class RabbitMQ(BaseProducer):
             logging.info("queue created")
 
     async def publish(self, message: dict) -> str:
-        encoded_message = jsonable_encoder(message)
+        # формат сообщения задается в настройках, ETL узнает его по content_type
+        body = codec.dumps(message, settings.CONTENT_TYPE)
+        # срок жизни - в заголовке и ttl сообщения, просроченное брокер удалит сам
+        expire_at = message["expire_at"].timestamp()
         if not self.queue:
             await self.create_queue()
         async with self.connection.channel() as channel:
             await channel.default_exchange.publish(
-                Message(body=json.dumps(encoded_message).encode('utf-8')),
+                Message(body=body, content_type=settings.CONTENT_TYPE, headers={EXPIRE_HEADER: int(expire_at)},
+                        expiration=max(expire_at - time.time(), 0)),
                 routing_key=self.queue.name)
         return "Message sent"
@@ -5,6 +5,8 @@ class Settings(BaseSettings):
     PROJECT_NAME: str = Field("Producer", env="UGC_PROJECT_NAME")
     PRODUCER_DSN: str = Field(env="RABBITMQ_NOTICE_URI")
     QUEUE_NAME: str = Field("notice", env="QUEUE_NAME")
+    # application/json или application/msgpack, см. src/codec.py
+    CONTENT_TYPE: str = Field("application/json", env="NOTICE_CONTENT_TYPE")
     ENABLE_TRACER: bool = Field(False, env="ENABLE_TRACER")
     JAEGER_HOST_NAME: str = Field("localhost", env="JAEGER_HOST_NAME")
     JAEGER_PORT: int = Field(6831, env="JAEGER_PORT")
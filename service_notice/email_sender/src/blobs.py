@@ -0,0 +1,18 @@
+import logging
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """Тела сообщений, которые ETL положил в redis вместо очереди (claim-check)"""
+
+    def __init__(self, uri: str):
+        # подключение откроется при первом запросе
+        self.redis = redis.from_url(uri)
+
+    def get(self, ref: str) -> str | None:
+        """Тело по ссылке из сообщения или None, если оно уже удалено по ttl"""
+        body = self.redis.get(ref)
+        return body.decode() if body is not None else None
@@ -0,0 +1,61 @@
+"""
+Формат сообщений в очередях. Формат выбирает отправитель, получатель узнает его по content_type:
+- application/json (или content_type не задан) - json;
+- application/msgpack - msgpack, UUID хранятся 16 байтами, а список получателей users_id -
+  одной строкой байт, по 16 байт на получателя.
+"""
+import datetime
+import json
+import uuid
+
+import msgpack
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/msgpack"
+CONTENT_TYPES = (CONTENT_TYPE_JSON, CONTENT_TYPE_MSGPACK)
+
+EXT_UUID = 1
+EXT_UUID_ARRAY = 2
+# поля, в которых лежат списки UUID
+UUID_ARRAYS = ("users_id",)
+
+
+def _json_default(obj):
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _default(obj):
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    if code == EXT_UUID_ARRAY:
+        return [uuid.UUID(bytes=data[i : i + 16]) for i in range(0, len(data), 16)]
+    return msgpack.ExtType(code, data)
+
+
+def pack_uuids(ids: list[uuid.UUID]) -> msgpack.ExtType:
+    return msgpack.ExtType(EXT_UUID_ARRAY, b"".join(id_.bytes for id_ in ids))
+
+
+def dumps(data: dict, content_type: str | None = CONTENT_TYPE_JSON) -> bytes:
+    if content_type == CONTENT_TYPE_MSGPACK:
+        data = {key: pack_uuids(value) if key in UUID_ARRAYS else value for key, value in data.items()}
+        return msgpack.packb(data, default=_default)
+    return json.dumps(data, default=_json_default).encode()
+
+
+def loads(body: bytes, content_type: str | None = CONTENT_TYPE_JSON) -> dict:
+    if content_type == CONTENT_TYPE_MSGPACK:
+        return msgpack.unpackb(body, ext_hook=_ext_hook)
+    return json.loads(body)
@@ -10,6 +10,7 @@ class Settings(BaseSettings):
     RABBITMQ_PASSWORD: str = Field("password", env="RABBITMQ_NOTICE_PASSWORD")
     RABBITMQ_HOST: str = Field("localhost", env="RABBITMQ_NOTICE_HOST")
     RABBITMQ_PORT: int = Field(5672, env="RABBITMQ_NOTICE_PORT")
+    REDIS_URI: str = Field("redis://localhost:6379/0", env="REDIS_NOTICE_DSN")
     EMAIL_QUEUE: str = "email"
     EMAIL_DLQ: str = "email-dlq"
     MAX_RETRIES: int = 3
@@ -5,8 +5,11 @@ import backoff
 import pika
 from pika.exceptions import AMQPConnectionError
 from pydantic import ValidationError
+from redis.exceptions import RedisError
 
+import codec
 import logging_config  # noqa
+from blobs import BlobStore
 from config import settings
 from models import EmailNotification
 from senders import BaseSender, DebugSender, SendgridSender
@@ -34,16 +37,45 @@ def init_rabbit():
     return channel
 
 
-def send_email(channel, method, properties, body, sender: BaseSender):
+def resolve_body(notification: EmailNotification, blobs: BlobStore) -> EmailNotification | None:
+    """Подставляет тело из redis, если в сообщении только ссылка. None - тело уже удалено по ttl"""
+    if notification.msg_body_ref is None:
+        return notification
+    if (body := blobs.get(notification.msg_body_ref)) is None:
+        logger.error("Body %s not found for notification %s", notification.msg_body_ref, notification.msg_id)
+        return None
+    notification.msg_body = body
+    return notification
+
+
+def send_email(channel, method, properties, body, sender: BaseSender, blobs: BlobStore):
     try:
-        notification = EmailNotification.parse_raw(body)
-    except ValidationError:
+        notification = EmailNotification.parse_obj(codec.loads(body, properties.content_type))
+    except (ValidationError, ValueError):
         logger.exception("Error on parsing body %s", body)
     else:
-        if (msg := sender.send(notification, priority=properties.priority)) is not None:
-            resend_properties = pika.BasicProperties(delivery_mode=2, priority=properties.priority)
+        try:
+            if resolve_body(notification, blobs) is None:
+                return
+        except RedisError:
+            logger.exception("Error on getting body %s", notification.msg_body_ref)
+            msg = sender.check_to_resend(notification)
+        else:
+            msg = sender.send(notification, priority=properties.priority)
+
+        if msg is not None:
+            # тело из redis обратно в очередь не кладем
+            if msg.msg_body_ref is not None:
+                msg.msg_body = ""
+            # повтор уходит в том же формате, в каком пришло сообщение
+            resend_properties = pika.BasicProperties(
+                content_type=properties.content_type, delivery_mode=2, priority=properties.priority
+            )
             channel.basic_publish(
-                exchange="", routing_key=settings.EMAIL_DLQ, properties=resend_properties, body=msg.json()
+                exchange="",
+                routing_key=settings.EMAIL_DLQ,
+                properties=resend_properties,
+                body=codec.dumps(msg.dict(), properties.content_type),
             )
     finally:
         channel.basic_ack(delivery_tag=method.delivery_tag)
@@ -54,7 +86,7 @@ def main():
         sender = DebugSender()
     else:
         sender = SendgridSender()
-    callback = partial(send_email, sender=sender)
+    callback = partial(send_email, sender=sender, blobs=BlobStore(settings.REDIS_URI))
 
     channel = init_rabbit()
 
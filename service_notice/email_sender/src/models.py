@@ -16,4 +16,5 @@ class EmailNotification(BaseModel):
     user_tz: str
     msg_meta: EmailMetadata
     msg_body: str
+    msg_body_ref: str | None = None  # ключ тела в redis, если ETL не положил его в сообщение
     retries: int = 0
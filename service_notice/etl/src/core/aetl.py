@@ -0,0 +1,485 @@
+"""
+Асинхронный вариант ETL на asyncio.
+Тот же контракт Extract/Transform/Load и те же отметки, что и в core.etl, но все обращения
+к RabbitMQ, Redis, PostgreSQL и auth не блокируют процесс, и одновременно обрабатывается
+до concurrency рассылок
+"""
+import asyncio
+import datetime
+import logging
+import uuid
+from collections import deque
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Iterable
+
+import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage, AbstractRobustConnection
+from jinja2 import Template
+from opentelemetry import trace
+
+import db.async_auth_api as db_auth
+import db.async_pg as db_pg
+import db.async_storage as db_redis
+from core import codec
+from core.backpressure import QueueDepth
+from core.cache import BoundedSet
+from core.config import settings
+from core.constants import QUEUE_NOTICE, TRANSPORT_CONTACT, Mark
+from core.etl import (
+    Batch,
+    Splitter,
+    Transformer,
+    cache_users,
+    compile_template,
+    get_cached_users,
+    get_queue_depth,
+    get_rate_limiter,
+    templates_cache,
+    templates_modified,
+)
+from core.exceptions import InvalidNoticeError, LoadError
+from core.models import USER_FIELDS, Message, Notice, UserInfo
+from core.ratelimit import RateLimiter
+from core.stats import stats
+from core.utils import expire_headers, get_ttl_from_datetime, is_expired
+
+tracer = trace.get_tracer(__name__)
+
+
+async def get_template(template_id: uuid.UUID) -> Template:
+    """Шаблон из общего с синхронным ETL кэша, см. core.etl.get_template"""
+    modified = templates_modified.get(template_id)
+    if modified is None:
+        modified = await db_pg.db.get_template_modified(template_id)
+        templates_modified.set(template_id, modified)
+
+    template = templates_cache.get((template_id, modified))
+    if template is None:
+        subject, template_str, modified = await db_pg.db.get_template(template_id)
+        template = compile_template(template_id, subject, template_str, modified)
+    return template
+
+
+async def get_users_info(
+    request_id: str,
+    user_ids: list[uuid.UUID],
+    fields: frozenset[str] = USER_FIELDS,
+    msg_type: str | None = None,
+    contact: str | None = None,
+) -> tuple[dict[uuid.UUID, UserInfo], dict[uuid.UUID, Mark]]:
+    """Кэш и фильтры в auth те же, что в core.etl.get_users_info"""
+    result, missed = get_cached_users(user_ids, fields)
+    rejected = {}
+    if missed:
+        users_info, rejected = await db_auth.db.get_users_info(request_id, missed, fields, msg_type, contact)
+        cache_users(users_info.values(), fields, result)
+    return result, rejected
+
+
+async def mark_processed(notice_id: uuid.UUID, position: int, result=Mark.QUEUED, ttl=24 * 60 * 60):
+    # добавляем к ttl 1мин чтобы гонок не было и если есть сообщение - в редис точно была отметка
+    await db_redis.db.add_mark(notice_id, position, result, ttl + 60)
+
+
+async def iter_users(users: Iterable[tuple[int, uuid.UUID]]) -> AsyncIterator[tuple[int, uuid.UUID]]:
+    for item in users:
+        yield item
+
+
+async def iter_audience(
+    request_id: str, audience: str, start: int = 0, after: uuid.UUID | None = None
+) -> AsyncIterator[tuple[int, uuid.UUID]]:
+    """См. core.etl.iter_audience"""
+    position = start
+    while True:
+        user_ids, after = await db_auth.db.get_audience_page(request_id, audience, after, settings.AUDIENCE_PAGE_SIZE)
+        for user_id in user_ids:
+            yield position, user_id
+            position += 1
+        if after is None:
+            return
+
+
+async def filter_processed(
+    notice_id: uuid.UUID, users: AsyncIterator[tuple[int, uuid.UUID]], start: int = 0
+) -> AsyncIterator[tuple[int, uuid.UUID]]:
+    """См. core.etl.filter_processed"""
+
+    async def filter_chunk(chunk: list[tuple[int, uuid.UUID]]):
+        first = chunk[0][0]
+        marks = db_redis.db.iter_marks(notice_id, chunk[-1][0] + 1, settings.MARKS_CHUNK_SIZE, first)
+        marks = [mark async for mark in marks]
+        for user in chunk:
+            if marks[user[0] - first] is None:
+                yield user
+
+    chunk = []
+    async for user in users:
+        if user[0] < start:
+            continue
+        chunk.append(user)
+        if len(chunk) >= settings.MARKS_CHUNK_SIZE:
+            async for item in filter_chunk(chunk):
+                yield item
+            chunk = []
+    if chunk:
+        async for item in filter_chunk(chunk):
+            yield item
+
+
+async def drop_duplicates(
+    users: AsyncIterator[tuple[int, uuid.UUID]],
+    window: int = 100_000,
+    on_duplicate: Callable[[int], Awaitable[None]] | None = None,
+) -> AsyncIterator[tuple[int, uuid.UUID]]:
+    """См. core.etl.drop_duplicates, on_duplicate - корутина"""
+    seen = BoundedSet(window)
+    async for position, user_id in users:
+        if seen.add(user_id):
+            yield position, user_id
+        elif on_duplicate is not None:
+            await on_duplicate(position)
+
+
+async def save_progress(notice_id: uuid.UUID, position: int, ttl=24 * 60 * 60, cursor: uuid.UUID | None = None):
+    await db_redis.db.flush()
+    await db_redis.db.set_checkpoint(notice_id, position, ttl + 60, cursor)
+
+
+class AsyncTransformer(Transformer):
+    """Рендер и проверки те же, что в Transformer, запросы к хранилищам и auth - асинхронные"""
+
+    def __init__(self, prefetch: int = 0):
+        super().__init__(0)
+        # сколько запросов к auth держать в работе наперед
+        self.async_prefetch = prefetch
+
+    async def user_info_lst(
+        self, data: Notice, users: AsyncIterator[tuple[int, uuid.UUID]], fields: frozenset[str], contact: str | None
+    ) -> AsyncIterator[tuple[int, uuid.UUID, list[tuple[int, UserInfo]], list[tuple[int, Mark]]]]:
+        async def fetch(users_batch: list[tuple[int, uuid.UUID]]):
+            user_ids = [user_id for _, user_id in users_batch]
+            users_info, rejected = await get_users_info(data.x_request_id, user_ids, fields, data.msg_type, contact)
+            return self.match_positions(users_batch, users_info, rejected)
+
+        pending = deque()
+        users_batch = []
+        try:
+            async for item in users:
+                users_batch.append(item)
+                if len(users_batch) < db_auth.db.batch_size.value:
+                    continue
+                pending.append(asyncio.create_task(fetch(users_batch)))
+                users_batch = []
+                if len(pending) > self.async_prefetch:
+                    yield await pending.popleft()
+            if users_batch:
+                pending.append(asyncio.create_task(fetch(users_batch)))
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def transform(self, data: Notice) -> AsyncIterator[Batch]:
+        with tracer.start_as_current_span("etl_transform") as span:
+            span.set_attribute("http.request_id", data.x_request_id)
+            span.set_attribute("transport", data.transport)
+
+            if data.expire_at < datetime.datetime.now(tz=datetime.timezone.utc):
+                logging.debug("message rejected due expire date: {0}".format(data.expire_at))
+                return
+
+            template = await get_template(data.template_id)
+            notice_id = data.notice_id
+            ttl = get_ttl_from_datetime(data.expire_at)
+            # узнаю повторная ли это обработка
+            is_repeat = not await db_redis.db.start_notice(notice_id, ttl + 60)
+            start, cursor = 0, None
+
+            if is_repeat:
+                start, cursor = await db_redis.db.get_checkpoint(notice_id)
+                span.set_attribute("resume_from", start)
+                logging.debug("resume notice:{0} from position {1}".format(notice_id, start))
+
+            # повторы ищем с начала списка, см. Transformer.transform
+            if data.audience:
+                users = iter_audience(data.x_request_id, data.audience, start, cursor)
+            else:
+                mark_duplicate = partial(mark_processed, notice_id, result=Mark.DUPLICATE, ttl=ttl)
+                users = drop_duplicates(iter_users(enumerate(data.users_id)), settings.DEDUP_WINDOW, mark_duplicate)
+            if is_repeat:
+                users = filter_processed(notice_id, users, start)
+
+            rendered = self.render_once(data, template)
+            fields = self.get_user_fields(data, template)
+            contact = TRANSPORT_CONTACT.get(data.transport)
+            async for end, cursor, users_info, rejected in self.user_info_lst(data, users, fields, contact):
+                batch = self.build_batch(data, template, end, users_info, rendered)
+                batch.rejected.extend(rejected)
+                batch.cursor = cursor if data.audience else None
+                for position, mark in batch.rejected:
+                    await mark_processed(notice_id, position, mark, ttl)
+                yield batch
+
+
+class AsyncLoader:
+    """
+    Ставит сообщения в очереди транспортов через канал с publisher confirms.
+    Сообщения публикуются окнами по confirm_window штук, подтверждения окна ждутся разом.
+    Большие тела уходят в redis, формат сообщений - content_type, ограничение скорости и пауза
+    для переполненных очередей - так же как в Loader. Очереди опрашиваются через probe_channel
+    """
+
+    def __init__(
+        self,
+        channel: AbstractChannel,
+        confirm_window: int = 1000,
+        confirm_timeout: float = 30,
+        blob_threshold: int = 0,
+        content_type: str = codec.CONTENT_TYPE_JSON,
+        rate_limiter: RateLimiter | None = None,
+        shared_rate_limit: bool = False,
+        queue_depth: QueueDepth | None = None,
+        probe_channel: AbstractChannel | None = None,
+        stopped: asyncio.Event | None = None,
+    ):
+        self.channel = channel
+        self.confirm_window = confirm_window
+        self.confirm_timeout = confirm_timeout
+        self.blob_threshold = blob_threshold
+        self.content_type = content_type
+        self.rate_limiter = rate_limiter
+        self.shared_rate_limit = shared_rate_limit
+        self.queue_depth = queue_depth
+        self.probe_channel = probe_channel
+        # событие остановки ETL, прерывает ожидание разгрузки очередей
+        self.stopped = stopped or asyncio.Event()
+
+    async def check_in_blobs(self, batch: Batch):
+        """Заменяем большие тела ссылками на redis, см. Loader.load"""
+        if not self.blob_threshold:
+            return
+        blob_refs = {}
+        ttl = get_ttl_from_datetime(batch.expire_at)
+        for _, msg in batch.messages:
+            if len(msg.msg_body) <= self.blob_threshold:
+                continue
+            if (ref := blob_refs.get(msg.msg_body)) is None:
+                ref = blob_refs[msg.msg_body] = await db_redis.db.put_blob(msg.msg_body.encode(), ttl + 60)
+            msg.msg_body, msg.msg_body_ref = "", ref
+
+    async def publish(self, queue: str, data: dict, priority: int, ttl: int | None = None, headers: dict | None = None):
+        message = aio_pika.Message(
+            codec.dumps(data, self.content_type),
+            content_type=self.content_type,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            priority=priority,
+            expiration=ttl,
+            headers=headers,
+        )
+        await self.channel.default_exchange.publish(message, routing_key=queue, timeout=self.confirm_timeout)
+
+    async def throttle(self, transport: str, priority: int):
+        """См. Loader.throttle. Задержки резервируются по очереди, поэтому сообщения окна расходятся во времени"""
+        if self.rate_limiter is None:
+            return
+        take = db_redis.db.take_tokens if self.shared_rate_limit else None
+        delay = await self.rate_limiter.acquire_async(transport, priority, take)
+        if delay:
+            stats.incr("rate_limit_wait", delay)
+            await asyncio.sleep(delay)
+
+    async def get_queue_depth(self, queue: str) -> int | None:
+        try:
+            declared = await self.probe_channel.declare_queue(queue, passive=True)
+            return declared.declaration_result.message_count
+        except aio_pika.exceptions.ChannelClosed as err:
+            logging.warning("can't get depth of queue {0}: {1}".format(queue, err))
+            await self.probe_channel.reopen()
+            return None
+
+    async def wait_for_drain(self, queue: str):
+        """
+        Ждем, пока очередь транспорта разгрузится. Ждет только задача этой рассылки, остальные продолжают работу.
+        При остановке ETL ждать перестаем: рассылка вернется в очередь и продолжится с контрольной точки
+        """
+        if self.queue_depth is None:
+            return
+        while True:
+            if self.queue_depth.need_sample(queue):
+                self.queue_depth.update(queue, await self.get_queue_depth(queue))
+            if not self.queue_depth.is_paused(queue):
+                return
+            if self.stopped.is_set():
+                raise LoadError("etl stopped while queue {0} is full".format(queue))
+            try:
+                await asyncio.wait_for(self.stopped.wait(), self.queue_depth.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def publish_message(self, batch: Batch, msg: Message, ttl: int):
+        await self.throttle(batch.transport, batch.priority)
+        await self.publish(batch.transport, msg.dict(), batch.priority, ttl)
+
+    async def publish_window(self, publications: list) -> list[bool]:
+        results = await asyncio.gather(*publications, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error("message not confirmed: {0!r}".format(result))
+        return [not isinstance(result, Exception) for result in results]
+
+    async def load(self, data: AsyncIterator[Batch]):
+        async for batch in data:
+            await self.wait_for_drain(batch.transport)
+            with tracer.start_as_current_span("etl_load") as span:
+                span.set_attribute("transport", batch.transport)
+                await self.check_in_blobs(batch)
+                # у всех сообщений пачки один expire_at, ttl считаем один раз на пачку
+                ttl = get_ttl_from_datetime(batch.expire_at)
+                for start in range(0, len(batch.messages), self.confirm_window):
+                    window = batch.messages[start : start + self.confirm_window]
+                    publications = [self.publish_message(batch, msg, ttl) for _, msg in window]
+                    confirmed = await self.publish_window(publications)
+                    for (position, msg), ok in zip(window, confirmed):
+                        if ok:
+                            await mark_processed(msg.notice_id, position, Mark.QUEUED, ttl)
+                    if not all(confirmed):
+                        raise LoadError("broker rejected {0} messages".format(confirmed.count(False)))
+
+            # пачка загружена целиком - сдвигаем контрольную точку
+            await save_progress(batch.notice_id, batch.end, ttl, batch.cursor)
+
+    async def load_notices(self, notices: Iterable[Notice]):
+        notices = list(notices)
+        for start in range(0, len(notices), self.confirm_window):
+            window = notices[start : start + self.confirm_window]
+            confirmed = await self.publish_window(
+                [
+                    self.publish(
+                        QUEUE_NOTICE,
+                        notice.dict(),
+                        notice.priority,
+                        max(get_ttl_from_datetime(notice.expire_at), 0),
+                        expire_headers(notice.expire_at),
+                    )
+                    for notice in window
+                ]
+            )
+            if not all(confirmed):
+                raise LoadError("broker rejected {0} notices".format(confirmed.count(False)))
+
+
+class AsyncETL:
+    def __init__(
+        self,
+        connection: AbstractRobustConnection,
+        concurrency: int = 10,
+        on_stats: Callable[[dict], None] | None = None,
+    ):
+        self.connection = connection
+        self.concurrency = concurrency
+        self.on_stats = on_stats
+        self.splitter = Splitter(settings.FANOUT_CHUNK_SIZE, settings.DEDUP_WINDOW)
+        self.transformer = AsyncTransformer(settings.AUTH_PREFETCH)
+        self.loader: AsyncLoader | None = None
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.stopped = asyncio.Event()
+        self.tasks: set[asyncio.Task] = set()
+
+    def stop(self):
+        self.stopped.set()
+        logging.info("stop etl")
+
+    def report_stats(self):
+        if self.on_stats:
+            self.on_stats(stats.snapshot())
+        else:
+            logging.info("etl stats: {0}".format(stats.snapshot()))
+
+    async def on_message(self, message: AbstractIncomingMessage):
+        task = asyncio.create_task(self.process(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def process(self, message: AbstractIncomingMessage):
+        if is_expired(message.headers):
+            # см. Extractor.get_data
+            logging.debug("notice rejected due expire header: {0}".format(message.headers))
+            stats.incr("expired_notices")
+            await message.ack()
+            return
+
+        async with self.semaphore:
+            logging.debug("extract message:{0}".format(message.body))
+            try:
+                data = Notice(**codec.loads(message.body, message.content_type))
+            except (ValueError, TypeError) as err:
+                # ошибки json, msgpack и ValidationError - ValueError. повтор не поможет, а неподтвержденное
+                # сообщение заняло бы место в prefetch до разрыва соединения
+                logging.error("notice rejected, invalid body: {0}".format(err))
+                stats.incr("invalid_notices")
+                await message.reject(requeue=False)
+                return
+            try:
+                if self.splitter.need_split(data):
+                    await self.loader.load_notices(self.splitter.split(data))
+                else:
+                    await self.loader.load(self.transformer.transform(data))
+            except LoadError as err:
+                logging.error("notice:{0} not loaded: {1}".format(data.notice_id, err))
+                await db_redis.db.flush()
+                await message.nack(requeue=True)
+                return
+            except InvalidNoticeError as err:
+                # повтор не поможет - подтверждаем, чтобы рассылка не возвращалась в очередь бесконечно
+                logging.error("notice:{0} rejected: {1}".format(data.notice_id, err))
+                await db_redis.db.flush()
+                await message.ack()
+                return
+            except Exception:
+                logging.exception("notice:{0} failed".format(data.notice_id))
+                await db_redis.db.flush()
+                await message.nack(requeue=True)
+                return
+
+            # если в процессе ничего не упало - сбрасываем отметки в redis и считаем что задание выполнено
+            await db_redis.db.flush()
+            await message.ack()
+
+    async def run(self):
+        consume_channel = await self.connection.channel()
+        await consume_channel.set_qos(prefetch_count=self.concurrency)
+        queue = await consume_channel.declare_queue(QUEUE_NOTICE, durable=True, arguments={"x-max-priority": 10})
+        publish_channel = await self.connection.channel(publisher_confirms=True)
+        queue_depth = get_queue_depth()
+        probe_channel = await self.connection.channel() if queue_depth else None
+        self.loader = AsyncLoader(
+            publish_channel,
+            settings.RABBITMQ_CONFIRM_WINDOW,
+            settings.RABBITMQ_CONFIRM_TIMEOUT,
+            settings.BLOB_THRESHOLD,
+            settings.CONTENT_TYPE,
+            get_rate_limiter(),
+            settings.RATE_LIMIT_SHARED,
+            queue_depth,
+            probe_channel,
+            self.stopped,
+        )
+
+        consumer_tag = await queue.consume(self.on_message)
+        while not self.stopped.is_set():
+            try:
+                await asyncio.wait_for(self.stopped.wait(), timeout=settings.STATS_LOG_INTERVAL)
+            except asyncio.TimeoutError:
+                self.report_stats()
+
+        # новых сообщений не берем, текущие доделываем
+        await queue.cancel(consumer_tag)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await publish_channel.close()
+        if probe_channel:
+            await probe_channel.close()
+        await consume_channel.close()
+        self.report_stats()
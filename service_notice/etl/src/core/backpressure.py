@@ -0,0 +1,40 @@
+import logging
+import time
+
+from core.stats import stats
+
+
+class QueueDepth:
+    """
+    Глубина очередей транспортов с гистерезисом.
+    Очередь, в которой high сообщений и больше, ставится на паузу и снимается с нее, только когда
+    опустится до low - так ETL не дергается на границе и брокер не копит сообщения, пока отправители лежат.
+    Глубину узнает Loader (passive queue_declare) не чаще раза в interval секунд на очередь
+    """
+
+    def __init__(self, high: int, low: int, interval: float = 1):
+        self.high = high
+        self.low = min(low, high)
+        self.interval = interval
+        self.paused: set[str] = set()
+        self.sampled_at: dict[str, float] = {}
+
+    def need_sample(self, queue: str) -> bool:
+        sampled_at = self.sampled_at.get(queue)
+        return sampled_at is None or time.monotonic() - sampled_at >= self.interval
+
+    def update(self, queue: str, depth: int | None):
+        """depth=None - глубину узнать не удалось, состояние очереди не меняем"""
+        self.sampled_at[queue] = time.monotonic()
+        if depth is None:
+            return
+        stats.set(f"queue_depth_{queue}", depth)
+        if depth >= self.high and queue not in self.paused:
+            self.paused.add(queue)
+            logging.warning("queue {0} has {1} messages, pause loading".format(queue, depth))
+        elif depth <= self.low and queue in self.paused:
+            self.paused.discard(queue)
+            logging.warning("queue {0} has {1} messages, resume loading".format(queue, depth))
+
+    def is_paused(self, queue: str) -> bool:
+        return queue in self.paused
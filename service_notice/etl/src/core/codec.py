@@ -0,0 +1,63 @@
+"""
+Формат сообщений в очередях. Формат выбирает отправитель, получатель узнает его по content_type:
+- application/json (или content_type не задан) - json;
+- application/msgpack - msgpack, UUID хранятся 16 байтами, а список получателей users_id -
+  одной строкой байт, по 16 байт на получателя (при разборе - core.models.UserIds).
+"""
+import datetime
+import uuid
+
+import msgpack
+import orjson
+
+from core.models import UserIds
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/msgpack"
+CONTENT_TYPES = (CONTENT_TYPE_JSON, CONTENT_TYPE_MSGPACK)
+
+EXT_UUID = 1
+EXT_UUID_ARRAY = 2
+# поля, в которых лежат списки UUID
+UUID_ARRAYS = ("users_id",)
+
+
+def _default(obj):
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    if code == EXT_UUID_ARRAY:
+        return UserIds(data)
+    return msgpack.ExtType(code, data)
+
+
+def pack_uuids(ids: list[uuid.UUID] | UserIds) -> msgpack.ExtType:
+    if isinstance(ids, UserIds):
+        return msgpack.ExtType(EXT_UUID_ARRAY, ids.data)
+    return msgpack.ExtType(EXT_UUID_ARRAY, b"".join(id_.bytes for id_ in ids))
+
+
+def _json_default(obj):
+    if isinstance(obj, UserIds):
+        return obj.to_list()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(data: dict, content_type: str | None = CONTENT_TYPE_JSON) -> bytes:
+    if content_type == CONTENT_TYPE_MSGPACK:
+        data = {key: pack_uuids(value) if key in UUID_ARRAYS else value for key, value in data.items()}
+        return msgpack.packb(data, default=_default)
+    return orjson.dumps(data, default=_json_default)
+
+
+def loads(body: bytes, content_type: str | None = CONTENT_TYPE_JSON) -> dict:
+    if content_type == CONTENT_TYPE_MSGPACK:
+        return msgpack.unpackb(body, ext_hook=_ext_hook)
+    return orjson.loads(body)
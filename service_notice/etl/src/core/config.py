@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Literal
 
 from pydantic import BaseSettings, Field
 
@@ -12,10 +13,80 @@ class Settings(BaseSettings):
     PG_URI: str = Field(..., env="NOTICE_ETL_PG_URI")
     AUTH_SERVICE_URI: str = Field(..., env="NOTICE_ETL_AUTH_SERVICE_URI")
     AUTH_API_PATH: str = "/auth/v1/userinfo"
+    AUTH_AUDIENCE_PATH: str = "/auth/v1/audience"
+    # сколько получателей аудитории запрашивать у auth за раз
+    AUDIENCE_PAGE_SIZE: int = Field(10_000, env="NOTICE_ETL_AUDIENCE_PAGE_SIZE")
+    # сколько пачек запрашивать у auth наперед, 0 - строго последовательно
+    AUTH_PREFETCH: int = Field(2, env="NOTICE_ETL_AUTH_PREFETCH")
+    # пул соединений к auth: размер, таймауты в секундах и повторы с экспоненциальной задержкой
+    AUTH_POOL_SIZE: int = Field(10, env="NOTICE_ETL_AUTH_POOL_SIZE")
+    AUTH_CONNECT_TIMEOUT: float = Field(3, env="NOTICE_ETL_AUTH_CONNECT_TIMEOUT")
+    AUTH_READ_TIMEOUT: float = Field(10, env="NOTICE_ETL_AUTH_READ_TIMEOUT")
+    AUTH_RETRIES: int = Field(3, env="NOTICE_ETL_AUTH_RETRIES")
+    AUTH_RETRY_BACKOFF: float = Field(0.3, env="NOTICE_ETL_AUTH_RETRY_BACKOFF")
+    # размер пачки к auth подбирается сам в пределах [MIN, MAX], чтобы ответ укладывался в TARGET_MS
+    AUTH_BATCH_SIZE: int = Field(100, env="NOTICE_ETL_AUTH_BATCH_SIZE")
+    AUTH_BATCH_SIZE_MIN: int = Field(10, env="NOTICE_ETL_AUTH_BATCH_SIZE_MIN")
+    AUTH_BATCH_SIZE_MAX: int = Field(1000, env="NOTICE_ETL_AUTH_BATCH_SIZE_MAX")
+    AUTH_BATCH_SIZE_STEP: int = Field(50, env="NOTICE_ETL_AUTH_BATCH_SIZE_STEP")
+    AUTH_BATCH_TARGET_MS: int = Field(200, env="NOTICE_ETL_AUTH_BATCH_TARGET_MS")
+    # рассылки больше FANOUT_CHUNK_SIZE получателей делятся на части для параллельной обработки, 0 - не делить
+    FANOUT_CHUNK_SIZE: int = Field(10_000, env="NOTICE_ETL_FANOUT_CHUNK_SIZE")
+    # повторы получателей в users_id отбрасываются, помним не больше DEDUP_WINDOW последних получателей
+    DEDUP_WINDOW: int = Field(100_000, env="NOTICE_ETL_DEDUP_WINDOW")
+    # кэш UserInfo: максимум записей и время жизни записи, сек
+    USERS_CACHE_SIZE: int = Field(100_000, env="NOTICE_ETL_USERS_CACHE_SIZE")
+    USERS_CACHE_TTL: int = Field(300, env="NOTICE_ETL_USERS_CACHE_TTL")
+    # как часто писать в лог статистику работы, сек
+    STATS_LOG_INTERVAL: int = Field(60, env="NOTICE_ETL_STATS_LOG_INTERVAL")
     REDIS_URI: str = Field(..., env="NOTICE_ETL_REDIS_URI")
     RABBITMQ_URI: str = Field(..., env="NOTICE_ETL_RABBITMQ_URI")
+    # True - брокер сам присылает сообщения (basic_consume), False - опрос очереди через basic_get
+    RABBITMQ_CONSUME: bool = Field(True, env="NOTICE_ETL_RABBITMQ_CONSUME")
+    RABBITMQ_PREFETCH_COUNT: int = Field(1, env="NOTICE_ETL_RABBITMQ_PREFETCH_COUNT")
+    # сколько рассылок обрабатывать одновременно, их пачки чередуются с учетом приоритета (см. core.scheduler)
+    ACTIVE_NOTICES: int = Field(4, env="NOTICE_ETL_ACTIVE_NOTICES")
+    # publisher confirms: не больше CONFIRM_WINDOW неподтвержденных сообщений, ожидание не дольше CONFIRM_TIMEOUT сек
+    RABBITMQ_CONFIRM: bool = Field(True, env="NOTICE_ETL_RABBITMQ_CONFIRM")
+    RABBITMQ_CONFIRM_WINDOW: int = Field(1000, env="NOTICE_ETL_RABBITMQ_CONFIRM_WINDOW")
+    RABBITMQ_CONFIRM_TIMEOUT: float = Field(30, env="NOTICE_ETL_RABBITMQ_CONFIRM_TIMEOUT")
+    # ограничение скорости постановки в очереди транспортов, сообщений в секунду (см. core.ratelimit):
+    # json вида {"email": 100, "sms": 10, "sms:9": 50}, ключ "транспорт:приоритет" точнее, чем "транспорт"
+    RATE_LIMITS: dict[str, float] = Field({}, env="NOTICE_ETL_RATE_LIMITS")
+    # запас токенов - на сколько секунд работы на полной скорости
+    RATE_LIMIT_BURST: float = Field(1, env="NOTICE_ETL_RATE_LIMIT_BURST")
+    # True - лимит общий для всех экземпляров ETL (ведро в redis), токены берутся оттуда по RATE_LIMIT_LEASE
+    RATE_LIMIT_SHARED: bool = Field(False, env="NOTICE_ETL_RATE_LIMIT_SHARED")
+    RATE_LIMIT_LEASE: int = Field(10, env="NOTICE_ETL_RATE_LIMIT_LEASE")
+    # очередь транспорта с BACKPRESSURE_HIGH сообщений ставится на паузу до BACKPRESSURE_LOW, 0 - не следить.
+    # глубина очередей проверяется раз в BACKPRESSURE_INTERVAL сек (см. core.backpressure)
+    BACKPRESSURE_HIGH: int = Field(0, env="NOTICE_ETL_BACKPRESSURE_HIGH")
+    BACKPRESSURE_LOW: int = Field(0, env="NOTICE_ETL_BACKPRESSURE_LOW")
+    BACKPRESSURE_INTERVAL: float = Field(1, env="NOTICE_ETL_BACKPRESSURE_INTERVAL")
     DEBUG: bool = Field(True, env="NOTICE_ETL_DEBUG")
+    # количество процессов ETL, 0 - по числу ядер
+    WORKERS: int = Field(1, env="NOTICE_ETL_WORKERS")
+    # sync - блокирующий ETL, async - ETL на asyncio
+    ETL_MODE: Literal["sync", "async"] = Field("sync", env="NOTICE_ETL_MODE")
+    # сколько сообщений асинхронный ETL обрабатывает одновременно
+    ASYNC_CONCURRENCY: int = Field(10, env="NOTICE_ETL_ASYNC_CONCURRENCY")
+    PG_POOL_SIZE: int = Field(5, env="NOTICE_ETL_PG_POOL_SIZE")
     SECRET_KEY: str = Field("secret_key", env="NOTICE_ETL_SECRET_KEY")
+    # сколько отметок читать из битовой карты redis за один GETRANGE
+    MARKS_CHUNK_SIZE: int = Field(1000, env="NOTICE_ETL_MARKS_CHUNK_SIZE")
+    # отметки пишутся в redis пачками: каждые MARKS_BUFFER_SIZE отметок или MARKS_FLUSH_INTERVAL_MS
+    MARKS_BUFFER_SIZE: int = Field(500, env="NOTICE_ETL_MARKS_BUFFER_SIZE")
+    MARKS_FLUSH_INTERVAL_MS: int = Field(500, env="NOTICE_ETL_MARKS_FLUSH_INTERVAL_MS")
+    # кэш скомпилированных шаблонов. изменения в админке видны не позже чем через TEMPLATE_CACHE_STALENESS сек
+    TEMPLATE_CACHE_SIZE: int = Field(128, env="NOTICE_ETL_TEMPLATE_CACHE_SIZE")
+    TEMPLATE_CACHE_TTL: int = Field(3600, env="NOTICE_ETL_TEMPLATE_CACHE_TTL")
+    TEMPLATE_CACHE_STALENESS: int = Field(30, env="NOTICE_ETL_TEMPLATE_CACHE_STALENESS")
+    # тела сообщений длиннее BLOB_THRESHOLD символов кладутся в redis, в очередь уходит только ссылка. 0 - выключено
+    BLOB_THRESHOLD: int = Field(0, env="NOTICE_ETL_BLOB_THRESHOLD")
+    # формат публикуемых сообщений: application/json или application/msgpack, см. core.codec
+    CONTENT_TYPE: Literal["application/json", "application/msgpack"] = Field(
+        "application/json", env="NOTICE_ETL_CONTENT_TYPE"
+    )
 
     JAEGER_HOST_NAME: str = Field("localhost", env="JAEGER_HOST_NAME")
     JAEGER_PORT: int = Field(6831, env="JAEGER_PORT")
@@ -1,6 +1,8 @@
 from enum import Enum
 
 QUEUE_NOTICE = "notice"
+# срок жизни рассылки (unix time, сек) в заголовке сообщения notice, чтобы не разбирать тело просроченных
+EXPIRE_HEADER = "x-expire-at"
 
 
 class Mark(Enum):
@@ -8,6 +10,8 @@ class Mark(Enum):
     REJECTED_NODATA = 1
     QUEUED = 2
     SENT = 3
+    # повтор получателя в users_id: сообщение ему ставится по первому вхождению
+    DUPLICATE = 4
 
 
 class Transport(str, Enum):
@@ -15,3 +19,16 @@ class Transport(str, Enum):
     SMS = "sms"
     WEBSOCKET = "websocket"
     PUSH = "push"
+
+
+# поле UserInfo с контактом, без которого транспорт не может отправить сообщение (см. Transformer.get_msg_meta)
+TRANSPORT_CONTACT = {
+    Transport.EMAIL: "email",
+    Transport.SMS: "phone",
+}
+
+# причины отказа из ответа auth
+REJECT_REASONS = {
+    "user": Mark.REJECTED_USER,
+    "nodata": Mark.REJECTED_NODATA,
+}
@@ -1,72 +1,310 @@
 import datetime
 import logging
-import math
 import time
 import uuid
-from typing import Generator
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import dropwhile, islice
+from typing import Callable, Generator, Iterable, Iterator
 
-import orjson
 import pika
-from jinja2 import Template
+from jinja2 import Template, meta
 from opentelemetry import trace
 
-from core.constants import QUEUE_NOTICE, Mark, Transport
-from core.models import Message, Notice, UserInfo
-from core.utils import get_ttl_from_datetime
-from db.auth_api import get_users_info_from_auth
-from db.pg import get_template_from_db
-from db.rmq import RabbitMQ
-from db.storage import get_mark, set_mark
+from core import codec
+from core.backpressure import QueueDepth
+from core.cache import BoundedSet, LRUCache
+from core.config import settings
+from core.constants import QUEUE_NOTICE, TRANSPORT_CONTACT, Mark, Transport
+from core.exceptions import InvalidNoticeError, LoadError
+from core.models import USER_FIELDS, Message, Notice, UserIds, UserInfo
+from core.ratelimit import RateLimiter
+from core.scheduler import ActiveNotice, Scheduler
+from core.stats import stats
+from core.utils import expire_headers, get_ttl_from_datetime, is_expired, prefetch_map
+from db.auth_api import get_audience_page_from_auth, get_batch_size, get_users_info_from_auth
+from db.pg import get_template_from_db, get_template_modified
+from db.rmq import ConfirmChannel, RabbitMQ
+from db.storage import (
+    flush_marks,
+    get_checkpoint,
+    get_marks,
+    put_blob,
+    set_checkpoint,
+    set_mark,
+    start_notice,
+    take_tokens,
+)
 
 # глушим вывод модуля rabbitmq, иначе он спамит в режиме debug
 logging.getLogger("pika").setLevel(logging.WARNING)
 
 tracer = trace.get_tracer(__name__)
 
+# скомпилированные шаблоны по (id, modified)
+templates_cache = LRUCache(settings.TEMPLATE_CACHE_SIZE, settings.TEMPLATE_CACHE_TTL)
+# последнее известное время изменения шаблона, перепроверяется раз в TEMPLATE_CACHE_STALENESS
+templates_modified = LRUCache(settings.TEMPLATE_CACHE_SIZE, settings.TEMPLATE_CACHE_STALENESS)
+stats.register("templates_cache", templates_cache.stats)
+# данные пользователей, которые часто получают рассылки: user_id -> (запрошенные поля, UserInfo).
+# отписка от рассылок вступит в силу не позже чем через USERS_CACHE_TTL
+users_cache = LRUCache(settings.USERS_CACHE_SIZE, settings.USERS_CACHE_TTL)
+stats.register("users_cache", users_cache.stats)
+
 
-# TODO можно завернуть в кэш
 def get_template(template_id: uuid.UUID) -> Template:
-    subject, template_str = get_template_from_db(str(template_id))
+    """
+    Шаблон из кэша.
+    Пока не истек TEMPLATE_CACHE_STALENESS, база не запрашивается совсем, потом проверяется только
+    время изменения шаблона. Шаблон перечитывается и компилируется, только если его поменяли в админке
+    """
+    modified = templates_modified.get(template_id)
+    if modified is None:
+        modified = get_template_modified(str(template_id))
+        templates_modified.set(template_id, modified)
+
+    template = templates_cache.get((template_id, modified))
+    if template is None:
+        subject, template_str, modified = get_template_from_db(str(template_id))
+        template = compile_template(template_id, subject, template_str, modified)
+    return template
+
+
+def get_user_fields(template: Template, source: str) -> set[str]:
+    """Поля UserInfo, которые использует шаблон"""
+    variables = meta.find_undeclared_variables(template.environment.parse(source))
+    return variables & set(UserInfo.__fields__)
+
+
+def compile_template(template_id: uuid.UUID, subject: str, template_str: str, modified) -> Template:
+    """
+    Компилирует шаблон и кладет его в кэш.
+    Заголовок тоже компилируется как шаблон. Для обоих запоминаем, от каких полей пользователя
+    они зависят: если ни от каких - их достаточно отрисовать один раз на сообщение
+    """
     template = Template(template_str)
+    template.user_fields = get_user_fields(template, template_str)
     template.subject = subject
+    template.subject_template = Template(subject)
+    template.subject_user_fields = get_user_fields(template.subject_template, subject)
+    templates_cache.set((template_id, modified), template)
+    templates_modified.set(template_id, modified)
     return template
 
 
-def get_users_info(request_id: str, user_ids: list[uuid.UUID]) -> dict[uuid.UUID, UserInfo]:
-    result = get_users_info_from_auth(request_id, user_ids)
-    return result
+def get_cached_users(
+    user_ids: list[uuid.UUID], fields: frozenset[str]
+) -> tuple[dict[uuid.UUID, UserInfo], list[uuid.UUID]]:
+    """Делит пользователей на найденных в кэше и промахи. Запись годится, если в ней есть все нужные поля"""
+    result = {}
+    missed = []
+    for user_id in user_ids:
+        cached = users_cache.get(user_id)
+        if cached is not None and fields <= cached[0]:
+            result[user_id] = cached[1]
+        else:
+            missed.append(user_id)
+    return result, missed
+
+
+def cache_users(users_info: Iterable[UserInfo], fields: frozenset[str], result: dict[uuid.UUID, UserInfo]):
+    for user_info in users_info:
+        users_cache.set(user_info.user_id, (fields, user_info))
+        result[user_info.user_id] = user_info
+
+
+def get_users_info(
+    request_id: str,
+    user_ids: list[uuid.UUID],
+    fields: frozenset[str] = USER_FIELDS,
+    msg_type: str | None = None,
+    contact: str | None = None,
+) -> tuple[dict[uuid.UUID, UserInfo], dict[uuid.UUID, Mark]]:
+    """
+    Данные пользователей сначала ищутся в кэше, в auth одной пачкой уходят только промахи.
+    Промахи auth сразу фильтрует по msg_type и contact и возвращает отказавших с причиной,
+    найденных в кэше проверяет build_batch
+    """
+    result, missed = get_cached_users(user_ids, fields)
+    rejected = {}
+    if missed:
+        users_info, rejected = get_users_info_from_auth(request_id, missed, fields, msg_type, contact)
+        cache_users(users_info.values(), fields, result)
+    return result, rejected
+
+
+def mark_processed(notice_id: uuid.UUID, position: int, result=Mark.QUEUED, ttl=24 * 60 * 60):
+    """Отметка для получателя с позицией position в Notice.users_id"""
+    # добавляем к ttl 1мин чтобы гонок не было и если есть сообщение - в редис точно была отметка
+    set_mark(notice_id, position, result, ttl + 60)
+
+
+def mark_started(notice_id: uuid.UUID, ttl=24 * 60 * 60) -> bool:
+    """Помечает сообщение как взятое в работу. Возвращает False, если это повторная обработка"""
+    return start_notice(notice_id, ttl + 60)
+
+
+def filter_processed(
+    notice_id: uuid.UUID, users: Iterable[tuple[int, uuid.UUID]], start: int = 0
+) -> Iterator[tuple[int, uuid.UUID]]:
+    """
+    Отдает (позиция, пользователь) начиная с позиции start только для тех, у кого еще нет отметки.
+    Позиции идут по возрастанию, пропуски (отброшенные повторы) допустимы. Отметки читаются пачками
+    """
+    users = dropwhile(lambda user: user[0] < start, users)
+    while chunk := list(islice(users, settings.MARKS_CHUNK_SIZE)):
+        first = chunk[0][0]
+        marks = list(get_marks(notice_id, chunk[-1][0] + 1, settings.MARKS_CHUNK_SIZE, first))
+        yield from (user for user in chunk if marks[user[0] - first] is None)
+
+
+def drop_duplicates(
+    users: Iterable[tuple[int, uuid.UUID]], window: int = 100_000, on_duplicate: Callable[[int], None] | None = None
+) -> Iterator[tuple[int, uuid.UUID]]:
+    """
+    Пропускаем повторы получателей, позиция остается за первым вхождением, on_duplicate(позиция) - для повторов.
+    Помним только window последних получателей, чтобы память не росла с размером рассылки
+    """
+    seen = BoundedSet(window)
+    for position, user_id in users:
+        if seen.add(user_id):
+            yield position, user_id
+        elif on_duplicate is not None:
+            on_duplicate(position)
+
+
+def iter_audience(
+    request_id: str, audience: str, start: int = 0, after: uuid.UUID | None = None
+) -> Iterator[tuple[int, uuid.UUID]]:
+    """
+    Получатели аудитории (позиция, пользователь) страницами из auth, в памяти только одна страница.
+    Позиции считаются от start, выборка идет после пользователя after
+    """
+    position = start
+    while True:
+        user_ids, after = get_audience_page_from_auth(request_id, audience, after, settings.AUDIENCE_PAGE_SIZE)
+        for user_id in user_ids:
+            yield position, user_id
+            position += 1
+        if after is None:
+            return
+
+
+def save_progress(notice_id: uuid.UUID, position: int, ttl=24 * 60 * 60, cursor: uuid.UUID | None = None):
+    """
+    Запоминаем, что все получатели до позиции position (и до cursor для аудиторий) полностью обработаны.
+    Перед этим сбрасываем отметки, чтобы контрольная точка не обогнала их
+    """
+    flush_marks()
+    set_checkpoint(notice_id, position, ttl + 60, cursor)
+
+
+def get_queue_depth() -> QueueDepth | None:
+    if not settings.BACKPRESSURE_HIGH:
+        return None
+    return QueueDepth(settings.BACKPRESSURE_HIGH, settings.BACKPRESSURE_LOW, settings.BACKPRESSURE_INTERVAL)
 
 
-def mark_processed(notice_id: uuid.UUID, user_id: uuid.UUID | int, result=Mark.QUEUED, ttl=24 * 60 * 60):
-    # добавляем к ttl 1мин чтобы гонок не было и если есть сообщение - в редис точно была отметка
-    set_mark(notice_id, user_id, result, ttl + 60)
+def get_rate_limiter() -> RateLimiter | None:
+    if not settings.RATE_LIMITS:
+        return None
+    lease = settings.RATE_LIMIT_LEASE if settings.RATE_LIMIT_SHARED else 1
+    return RateLimiter(settings.RATE_LIMITS, settings.RATE_LIMIT_BURST, lease)
 
 
-def is_processed(notice_id: uuid.UUID, user_id: uuid.UUID | int) -> bool:
-    result = get_mark(notice_id, user_id)
-    return result is not None
+@dataclass
+class Batch:
+    """Пачка сообщений одной рассылки, которую Loader загружает целиком"""
+
+    notice_id: uuid.UUID
+    transport: str
+    priority: int
+    expire_at: datetime.datetime
+    # позиция, следующая за последним получателем пачки
+    end: int
+    messages: list[tuple[int, Message]] = field(default_factory=list)
+    # получатели, которым сообщение не отправляется: (позиция, причина)
+    rejected: list[tuple[int, Mark]] = field(default_factory=list)
+    # последний получатель пачки, для аудиторий - курсор выборки из auth
+    cursor: uuid.UUID | None = None
 
 
 class Extractor:
-    def __init__(self, rmq: RabbitMQ):
+    """
+    Забирает сообщения из очереди notice.
+    В режиме consume брокер сам присылает сообщения (basic_consume, до prefetch_count неподтвержденных),
+    иначе очередь опрашивается через basic_get. Подтверждение - только после загрузки, через mark_done
+    """
+
+    def __init__(self, rmq: RabbitMQ, consume: bool = True, prefetch_count: int = 1, inactivity_timeout: float = 1):
         self.channel = rmq.connection.channel()
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=prefetch_count)
         self.channel.queue_declare(queue="notice", durable=True, arguments={"x-max-priority": 10})
         self.current_delivery_tag = None
+        self.consumer = None
+        if consume:
+            # inactivity_timeout нужен, чтобы при пустой очереди периодически возвращать управление
+            # и дать ETL проверить, не пора ли остановиться
+            self.consumer = self.channel.consume(QUEUE_NOTICE, auto_ack=False, inactivity_timeout=inactivity_timeout)
+
+    def get_data(self, wait: bool = True):
+        """
+        Следующая рассылка или None, если очередь пуста. delivery_tag сообщения - в current_delivery_tag.
+        wait=False - не ждать сообщений от брокера, когда в буфере consumer ничего нет
+        """
+        while True:
+            if self.consumer:
+                if not wait and not self.channel.get_waiting_message_count():
+                    # забираем то, что уже пришло в сокет, не блокируясь
+                    self.channel.connection.process_data_events(time_limit=0)
+                    if not self.channel.get_waiting_message_count():
+                        return None
+                method_frame, header_frame, body = next(self.consumer)
+            else:
+                method_frame, header_frame, body = self.channel.basic_get(QUEUE_NOTICE, auto_ack=False)
+            if not method_frame:
+                return None
+
+            if is_expired(header_frame.headers):
+                # просроченную рассылку выбрасываем по заголовку, тело (может быть огромным) не разбираем
+                logging.debug("notice rejected due expire header: {0}".format(header_frame.headers))
+                stats.incr("expired_notices")
+                self.channel.basic_ack(method_frame.delivery_tag)
+                continue
 
-    def get_data(self):
-        method_frame, header_frame, body = self.channel.basic_get(QUEUE_NOTICE, auto_ack=False)
-        if method_frame:
             logging.debug("extract message:{0}".format(body))
             self.current_delivery_tag = method_frame.delivery_tag
-            notice_dict = orjson.loads(body)
+            # формат выбирает отправитель, см. core.codec
+            notice_dict = codec.loads(body, header_frame.content_type)
             return Notice(**notice_dict)
 
-    def mark_done(self):
-        self.channel.basic_ack(self.current_delivery_tag)
+    def mark_done(self, delivery_tag: int | None = None):
+        self.channel.basic_ack(delivery_tag or self.current_delivery_tag)
+
+    def mark_failed(self, delivery_tag: int | None = None):
+        """Возвращаем задание в очередь, чтобы обработать его заново"""
+        self.channel.basic_nack(delivery_tag or self.current_delivery_tag, requeue=True)
+
+    def close(self):
+        if self.consumer:
+            # неподтвержденные сообщения из буфера возвращаются в очередь
+            requeued = self.channel.cancel()
+            self.consumer = None
+            logging.debug("consumer cancelled, requeued {0} messages".format(requeued))
 
 
 class Transformer:
+    def __init__(self, prefetch: int = 0):
+        # сколько запросов к auth выполнять наперед, пока идет рендер и загрузка текущей пачки
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="auth") if prefetch > 0 else None
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+
     @staticmethod
     def get_msg_meta(data: Notice, user_info: UserInfo, subject: str = "Movies") -> dict | None:
         transport = data.transport
@@ -86,23 +324,42 @@ class Transformer:
         # если ничего не выдали до этого, значит вернем None и сообщение не отправится
         return None
 
-    def transform(self, data: Notice):
-        def user_info_lst(request_id: str, user_lst: list[uuid.UUID], batch_size=100):
+    @staticmethod
+    def get_user_fields(data: Notice, template: Template) -> frozenset[str]:
+        """
+        Поля UserInfo, которые нужно запросить у auth: нужные транспорту (см. get_msg_meta),
+        используемые шаблоном и не перекрытые extra, и нужные всегда
+        """
+        fields = {"user_id", "time_zone", "reject_notice"}
+        if contact := TRANSPORT_CONTACT.get(data.transport):
+            fields.add(contact)
+        fields |= (template.user_fields | template.subject_user_fields) - data.extra.keys()
+        return frozenset(fields)
+
+    def transform(self, data: Notice) -> Generator[Batch, None, None]:
+        def user_info_lst(
+            request_id: str, user_lst: Iterable[tuple[int, uuid.UUID]], fields: frozenset[str], contact: str | None
+        ):
             """
             Для оптимизации - выполнение запросов пачками к auth
-            Пачка не больше batch_size
+            Размер пачки подстраивается под время ответа auth (см. get_batch_size).
+            Отдает позицию после пачки, последнего получателя пачки,
+            пары (позиция в users_id, user_info) и отказы, найденные auth.
+            Следующие self.prefetch пачек запрашиваются в фоне, пока обрабатывается текущая
             """
-            window_count = math.ceil(len(user_lst) / batch_size)
-            for window in range(window_count):
-                start = window * batch_size
-                users_batch = user_lst[start : start + batch_size]
-                user_info_dict = get_users_info(request_id, users_batch)
-                # TODO что делать с пользователями без user_info?
-                if len(users_batch) > len(user_info_dict):
-                    logging.debug("Not found users info: {0}".format(len(users_batch) - len(user_info_dict)))
-                yield from user_info_dict.values()
-
-        with tracer.start_as_current_span("etl_transform") as span:
+
+            def fetch(users_batch: list[tuple[int, uuid.UUID]]):
+                user_ids = [user_id for _, user_id in users_batch]
+                users_info, rejected = get_users_info(request_id, user_ids, fields, data.msg_type, contact)
+                return self.match_positions(users_batch, users_info, rejected)
+
+            users_iter = iter(user_lst)
+            batches = iter(lambda: list(islice(users_iter, get_batch_size())), [])
+            yield from prefetch_map(fetch, batches, self.prefetch, self.executor)
+
+        # спан не делаем текущим: генераторы нескольких рассылок чередуются (см. core.scheduler),
+        # а текущий контекст у них общий
+        with tracer.start_span("etl_transform") as span:
             span.set_attribute("http.request_id", data.x_request_id)
             span.set_attribute("transport", data.transport)
 
@@ -114,93 +371,440 @@ class Transformer:
             notice_id = data.notice_id
             ttl = get_ttl_from_datetime(data.expire_at)
             # узнаю повторная ли это обработка
-            is_repeat = is_processed(notice_id, 0)
-            users = data.users_id
-
-            if not is_repeat:
-                mark_processed(notice_id, 0, ttl=ttl)
+            is_repeat = not mark_started(notice_id, ttl)
+            start, cursor = 0, None
+
+            if is_repeat:
+                # пользователи отправляются последовательно, поэтому сразу переходим
+                # к контрольной точке - все получатели до нее уже обработаны.
+                # после нее фильтруем пользователей, оставляя только тех, что еще не обрабатывали
+                start, cursor = get_checkpoint(notice_id)
+                span.set_attribute("resume_from", start)
+                logging.debug("resume notice:{0} from position {1}".format(notice_id, start))
+
+            if data.audience:
+                # получатели не лежат в сообщении, а выбираются из auth страницами, повторов у них не бывает
+                users = iter_audience(data.x_request_id, data.audience, start, cursor)
             else:
-                # фильтруем пользователей, оставляя только тех, что еще не обрабатывали.
-                # не очень то оптимально....
-                # с учетом того, что данные отправляются последовательно, можно
-                # в дальнейшем оптимизировать поиск последнего обработанного пользователя
-                users = list(filter(lambda x: not is_processed(notice_id, x), users))
-
-            for user_info in user_info_lst(data.x_request_id, users):
-                # пропускаем, если пользователь отказался от некоторых рассылок
-                if data.msg_type in user_info.reject_notice:
-                    # помечаем сообщение как отвергнутое
-                    mark_processed(data.notice_id, user_info.user_id, Mark.REJECTED_USER, ttl)
-                    continue
-
-                msg_body = template.render(user_info.dict() | data.extra)
-                msg_meta = self.get_msg_meta(data, user_info, template.subject)
-                # для случаев, когда не можем отправить сообщение,
-                # потому что не хватает данных для отправки, например телефона
-                if msg_meta is None:
-                    mark_processed(data.notice_id, user_info.user_id, Mark.REJECTED_NODATA, ttl)
-                    continue
-
-                message = Message(
-                    x_request_id=data.x_request_id,
-                    notice_id=data.notice_id,
-                    msg_id=uuid.uuid4(),
-                    user_id=user_info.user_id,
-                    user_tz=user_info.time_zone,
-                    msg_meta=msg_meta,
-                    msg_body=msg_body,
-                    expire_at=data.expire_at,
-                )
-                yield data.transport, data.priority, message
+                # повторы ищем с начала списка, в т.ч. среди уже отмеченных и до контрольной точки:
+                # иначе при повторной обработке копия получателя, чье первое вхождение уже обработано, ушла бы снова
+                mark_duplicate = partial(mark_processed, notice_id, result=Mark.DUPLICATE, ttl=ttl)
+                users = drop_duplicates(enumerate(data.users_id), settings.DEDUP_WINDOW, mark_duplicate)
+            if is_repeat:
+                users = filter_processed(notice_id, users, start)
+
+            rendered = self.render_once(data, template)
+            fields = self.get_user_fields(data, template)
+            contact = TRANSPORT_CONTACT.get(data.transport)
+            for end, cursor, users_info, rejected in user_info_lst(data.x_request_id, users, fields, contact):
+                batch = self.build_batch(data, template, end, users_info, rendered)
+                batch.rejected.extend(rejected)
+                # курсор нужен только аудиториям, списку из сообщения хватает позиции
+                batch.cursor = cursor if data.audience else None
+                for position, mark in batch.rejected:
+                    mark_processed(notice_id, position, mark, ttl)
+                yield batch
+
+    @staticmethod
+    def match_positions(
+        users_batch: list[tuple[int, uuid.UUID]], users_info: dict[uuid.UUID, UserInfo], rejected: dict[uuid.UUID, Mark]
+    ) -> tuple[int, uuid.UUID, list[tuple[int, UserInfo]], list[tuple[int, Mark]]]:
+        """
+        Раскладывает ответ по позициям получателей:
+        (позиция после пачки, последний получатель пачки, user_info, отказы)
+        """
+        positions = {user_id: position for position, user_id in users_batch}
+        # TODO что делать с пользователями без user_info?
+        if len(positions) > len(users_info) + len(rejected):
+            logging.debug("Not found users info: {0}".format(len(positions) - len(users_info) - len(rejected)))
+        end = users_batch[-1][0] + 1
+        return (
+            end,
+            users_batch[-1][1],
+            [(positions[user_id], user_info) for user_id, user_info in users_info.items()],
+            [(positions[user_id], mark) for user_id, mark in rejected.items()],
+        )
+
+    @staticmethod
+    def render_once(data: Notice, template: Template) -> tuple[str | None, str | None]:
+        """
+        Отрисовка тела и заголовка, общая для всех получателей сообщения.
+        None - шаблон использует поля пользователя (и их не перекрывает extra), рисуем для каждого
+        """
+        body = subject = None
+        if not template.user_fields - data.extra.keys():
+            body = template.render(data.extra)
+        if not template.subject_user_fields - data.extra.keys():
+            subject = template.subject_template.render(data.extra)
+        return body, subject
+
+    def build_batch(
+        self,
+        data: Notice,
+        template: Template,
+        end: int,
+        users_info: list[tuple[int, UserInfo]],
+        rendered: tuple[str | None, str | None] = (None, None),
+    ) -> Batch:
+        """Готовит сообщения пачки. Отметки для отвергнутых получателей ставит вызывающий по batch.rejected"""
+        batch = Batch(
+            notice_id=data.notice_id,
+            transport=data.transport,
+            priority=data.priority,
+            expire_at=data.expire_at,
+            end=end,
+        )
+        for position, user_info in users_info:
+            # пропускаем, если пользователь отказался от некоторых рассылок
+            if data.msg_type in user_info.reject_notice:
+                # помечаем сообщение как отвергнутое
+                batch.rejected.append((position, Mark.REJECTED_USER))
+                continue
+
+            msg_body, subject = rendered
+            if msg_body is None or subject is None:
+                context = user_info.dict() | data.extra
+                msg_body = template.render(context) if msg_body is None else msg_body
+                subject = template.subject_template.render(context) if subject is None else subject
+            msg_meta = self.get_msg_meta(data, user_info, subject)
+            # для случаев, когда не можем отправить сообщение,
+            # потому что не хватает данных для отправки, например телефона
+            if msg_meta is None:
+                batch.rejected.append((position, Mark.REJECTED_NODATA))
+                continue
+
+            message = Message(
+                x_request_id=data.x_request_id,
+                notice_id=data.notice_id,
+                msg_id=uuid.uuid4(),
+                user_id=user_info.user_id,
+                user_tz=user_info.time_zone,
+                msg_meta=msg_meta,
+                msg_body=msg_body,
+                expire_at=data.expire_at,
+            )
+            batch.messages.append((position, message))
+        return batch
 
 
 class Loader:
-    def __init__(self, rmq: RabbitMQ):
-        self.channel = rmq.connection.channel()
+    """
+    Ставит сообщения в очереди транспортов.
+    В режиме confirm брокер подтверждает прием сообщений (publisher confirms). Подтверждения ждутся
+    не по одному, а пачкой: без ожидания публикуется до confirm_window сообщений, отметка QUEUED
+    ставится только после подтверждения, контрольная точка - когда подтверждена вся пачка.
+    Тела длиннее blob_threshold символов кладутся в redis, в сообщении остается только ссылка (claim-check).
+    content_type - формат публикуемых сообщений, см. core.codec.
+    rate_limiter ограничивает скорость по транспортам, при shared_rate_limit - общую для всех экземпляров ETL.
+    queue_depth - пауза для транспортов, чьи очереди переполнены (отправители не успевают или лежат)
+    """
+
+    def __init__(
+        self,
+        rmq: RabbitMQ,
+        confirm: bool = True,
+        confirm_window: int = 1000,
+        confirm_timeout: float = 30,
+        blob_threshold: int = 0,
+        content_type: str = codec.CONTENT_TYPE_JSON,
+        rate_limiter: RateLimiter | None = None,
+        shared_rate_limit: bool = False,
+        queue_depth: QueueDepth | None = None,
+    ):
+        self.connection = rmq.connection
+        self.confirm = confirm
+        self.confirm_window = confirm_window
+        self.confirm_timeout = confirm_timeout
+        # delivery_tag -> отметка, которую нужно поставить после подтверждения (None - отметка не нужна)
+        self.unconfirmed: OrderedDict[int, tuple[uuid.UUID, int, int] | None] = OrderedDict()
+        self.nacked = 0
+        self.blob_threshold = blob_threshold
+        self.content_type = content_type
+        self.rate_limiter = rate_limiter
+        self.shared_rate_limit = shared_rate_limit
+        self.queue_depth = queue_depth
+        # отдельный канал для опроса очередей: passive queue_declare несуществующей очереди закрывает канал
+        self.probe_channel = rmq.connection.channel() if queue_depth else None
+        self.channel = ConfirmChannel(rmq.connection, self.on_confirm) if confirm else rmq.connection.channel()
+
+    def on_confirm(self, frame: pika.frame.Method):
+        """Подтверждение (Basic.Ack) или отказ (Basic.Nack) брокера, возможно сразу для нескольких сообщений"""
+        confirmed = isinstance(frame.method, pika.spec.Basic.Ack)
+        tag = frame.method.delivery_tag
+        tags = [t for t in self.unconfirmed if t <= tag] if frame.method.multiple else [tag]
+        for t in tags:
+            mark = self.unconfirmed.pop(t)
+            if not confirmed:
+                self.nacked += 1
+            elif mark is not None:
+                mark_processed(mark[0], mark[1], Mark.QUEUED, mark[2])
+        if not confirmed:
+            logging.error("broker rejected {0} messages".format(len(tags)))
+
+    def wait_for_confirms(self, max_unconfirmed: int = 0):
+        """Ждем, пока неподтвержденных сообщений останется не больше max_unconfirmed"""
+        deadline = time.monotonic() + self.confirm_timeout
+        while len(self.unconfirmed) > max_unconfirmed:
+            if time.monotonic() > deadline:
+                count = len(self.unconfirmed)
+                # ждать старые подтверждения дальше незачем: пачка будет обработана заново на новом канале
+                self.channel.reopen()
+                self.unconfirmed.clear()
+                self.nacked = 0
+                raise LoadError("no publisher confirms for {0} messages".format(count))
+            self.connection.process_data_events(time_limit=0.1)
+        if self.nacked:
+            nacked, self.nacked = self.nacked, 0
+            raise LoadError("broker rejected {0} messages".format(nacked))
+
+    def publish(self, queue: str, body: bytes, properties: pika.BasicProperties):
+        self.channel.basic_publish(exchange="", routing_key=queue, body=body, properties=properties)
+
+    def throttle(self, transport: str, priority: int):
+        """Ждем, если транспорт уперся в лимит. Пока ждем - забираем подтверждения брокера"""
+        if self.rate_limiter is None:
+            return
+        delay = self.rate_limiter.acquire(transport, priority, take_tokens if self.shared_rate_limit else None)
+        if delay:
+            stats.incr("rate_limit_wait", delay)
+            self.connection.sleep(delay)
+
+    def get_queue_depth(self, queue: str) -> int | None:
+        try:
+            return self.probe_channel.queue_declare(queue, passive=True).method.message_count
+        except pika.exceptions.ChannelClosedByBroker as err:
+            logging.warning("can't get depth of queue {0}: {1}".format(queue, err))
+            self.probe_channel = self.connection.channel()
+            return None
+
+    def is_paused(self, queue: str) -> bool:
+        """Очередь транспорта переполнена, грузить в нее пока нельзя"""
+        if self.queue_depth is None:
+            return False
+        if self.queue_depth.need_sample(queue):
+            self.queue_depth.update(queue, self.get_queue_depth(queue))
+        return self.queue_depth.is_paused(queue)
+
+    def need_blob(self, msg: Message) -> bool:
+        return 0 < self.blob_threshold < len(msg.msg_body)
 
     def send_message(self, queue: str, msg: Message, ttl: int, priority: int):
-        properties = pika.BasicProperties(expiration=str(ttl * 1000), delivery_mode=2, priority=priority)
-        self.channel.basic_publish(exchange="", routing_key=queue, properties=properties, body=msg.json())
+        properties = pika.BasicProperties(
+            content_type=self.content_type, expiration=str(ttl * 1000), delivery_mode=2, priority=priority
+        )
+        self.publish(queue, codec.dumps(msg.dict(), self.content_type), properties)
         logging.debug("message loaded in [{1}]: {0}".format(msg.dict(), queue))
 
-    def load(self, data: Generator[tuple[str, int, Message], None, None]):
-        for transport, priority, msg in data:
+    def load_notices(self, notices: Iterable[Notice]):
+        """Ставим рассылки обратно в очередь notice, например части большой рассылки"""
+        for notice in notices:
+            if self.confirm:
+                self.wait_for_confirms(self.confirm_window - 1)
+                self.unconfirmed[self.channel.delivery_tag + 1] = None
+            properties = pika.BasicProperties(
+                content_type=self.content_type,
+                delivery_mode=2,
+                priority=notice.priority,
+                headers=expire_headers(notice.expire_at),
+                expiration=str(max(get_ttl_from_datetime(notice.expire_at), 0) * 1000),
+            )
+            self.publish(QUEUE_NOTICE, codec.dumps(notice.dict(), self.content_type), properties)
+            logging.debug("notice:{0} queued, parent:{1}".format(notice.notice_id, notice.parent_id))
+        if self.confirm:
+            self.wait_for_confirms()
+
+    def load(self, data: Generator[Batch, None, None]):
+        for batch in data:
+            self.load_batch(batch)
+
+    def load_batch(self, batch: Batch):
+        # тело -> ключ в redis. одинаковые тела (см. Transformer.render_once) сохраняются один раз
+        blob_refs = {}
+        # у всех сообщений пачки один expire_at, ttl считаем один раз на пачку
+        ttl = get_ttl_from_datetime(batch.expire_at)
+        for position, msg in batch.messages:
             with tracer.start_as_current_span("etl_load") as span:
                 # делаем трассировку
                 span.set_attribute("http.request_id", msg.x_request_id)
-                span.set_attribute("transport", transport)
+                span.set_attribute("transport", batch.transport)
 
                 # ставим в очередь на отправку
-                ttl = get_ttl_from_datetime(msg.expire_at)
-                self.send_message(queue=transport, msg=msg, ttl=ttl, priority=priority)
-
-                # помечаем как обработанное
-                mark_processed(msg.notice_id, msg.user_id, Mark.QUEUED, ttl)
+                if self.need_blob(msg):
+                    if (ref := blob_refs.get(msg.msg_body)) is None:
+                        ref = blob_refs[msg.msg_body] = put_blob(msg.msg_body.encode(), ttl + 60)
+                    if ref is not None:
+                        msg.msg_body, msg.msg_body_ref = "", ref
+                self.throttle(batch.transport, batch.priority)
+                if self.confirm:
+                    self.wait_for_confirms(self.confirm_window - 1)
+                    self.unconfirmed[self.channel.delivery_tag + 1] = (msg.notice_id, position, ttl)
+                self.send_message(queue=batch.transport, msg=msg, ttl=ttl, priority=batch.priority)
+
+                # помечаем как обработанное, в режиме confirm - после подтверждения брокера
+                if not self.confirm:
+                    mark_processed(msg.notice_id, position, Mark.QUEUED, ttl)
+
+        if self.confirm:
+            self.wait_for_confirms()
+        # пачка загружена целиком - сдвигаем контрольную точку
+        save_progress(batch.notice_id, batch.end, ttl, batch.cursor)
+
+
+class Splitter:
+    """
+    Делит большую рассылку на части по chunk_size получателей.
+    Каждая часть - отдельная рассылка со своим notice_id, поэтому отметки, контрольные точки
+    и повторная обработка работают для частей независимо, а сами части могут параллельно
+    обрабатывать разные экземпляры ETL. id частей детерминированы: если исходная рассылка
+    придет повторно, совпавшие части будут отброшены как уже обработанные
+    """
+
+    def __init__(self, chunk_size: int = 0, dedup_window: int = 100_000):
+        self.chunk_size = chunk_size
+        self.dedup_window = dedup_window
+
+    def need_split(self, data: Notice) -> bool:
+        # части повторно не делим, просроченные рассылки отбросит Transformer.
+        # получателей аудитории выбирает auth, делить нечего
+        if data.parent_id is not None or data.audience:
+            return False
+        if data.expire_at < datetime.datetime.now(tz=datetime.timezone.utc):
+            return False
+        return 0 < self.chunk_size < len(data.users_id)
+
+    def split(self, data: Notice) -> Iterator[Notice]:
+        # повторы отбрасываем до деления, иначе копии получателя из разных частей ушли бы каждая
+        users = drop_duplicates(enumerate(data.users_id), self.dedup_window)
+        users_id = UserIds.parse(user_id for _, user_id in users)
+        for number, start in enumerate(range(0, len(users_id), self.chunk_size)):
+            yield data.copy(
+                update={
+                    "notice_id": uuid.uuid5(data.notice_id, "chunk:{0}".format(number)),
+                    "parent_id": data.notice_id,
+                    "users_id": users_id[start : start + self.chunk_size],
+                }
+            )
 
 
 class ETL:
     is_run = False
 
-    def __init__(self, rmq: RabbitMQ):
-        self.extractor = Extractor(rmq)
-        self.transformer = Transformer()
-        self.loader = Loader(rmq)
+    def __init__(self, rmq: RabbitMQ, on_stats: Callable[[dict], None] | None = None):
+        # куда отдавать снимок статистики, по умолчанию - в лог
+        self.on_stats = on_stats
+        # в работе может быть несколько рассылок, их сообщения из notice подтверждаются по отдельности
+        self.scheduler = Scheduler(settings.ACTIVE_NOTICES)
+        prefetch_count = max(settings.RABBITMQ_PREFETCH_COUNT, settings.ACTIVE_NOTICES)
+        self.extractor = Extractor(rmq, settings.RABBITMQ_CONSUME, prefetch_count)
+        self.splitter = Splitter(settings.FANOUT_CHUNK_SIZE, settings.DEDUP_WINDOW)
+        self.transformer = Transformer(settings.AUTH_PREFETCH)
+        self.loader = Loader(
+            rmq,
+            settings.RABBITMQ_CONFIRM,
+            settings.RABBITMQ_CONFIRM_WINDOW,
+            settings.RABBITMQ_CONFIRM_TIMEOUT,
+            settings.BLOB_THRESHOLD,
+            settings.CONTENT_TYPE,
+            get_rate_limiter(),
+            settings.RATE_LIMIT_SHARED,
+            get_queue_depth(),
+        )
 
     def stop(self):
         self.is_run = False
         logging.info("stop etl")
 
+    def report_stats(self):
+        if self.on_stats:
+            self.on_stats(stats.snapshot())
+        else:
+            logging.info("etl stats: {0}".format(stats.snapshot()))
+
+    def admit(self, data: Notice, delivery_tag: int):
+        """Берем рассылку в работу: большую сразу делим на части, остальные обрабатывает scheduler"""
+        if not self.splitter.need_split(data):
+            self.scheduler.add(data, delivery_tag, self.transformer.transform(data))
+            return
+
+        # большую рассылку раскладываем на части, их заберут все свободные экземпляры ETL
+        try:
+            with tracer.start_as_current_span("etl_split") as span:
+                span.set_attribute("http.request_id", data.x_request_id)
+                self.loader.load_notices(self.splitter.split(data))
+        except LoadError as err:
+            logging.error("notice:{0} not split: {1}".format(data.notice_id, err))
+            self.extractor.mark_failed(delivery_tag)
+            return
+        self.extractor.mark_done(delivery_tag)
+
+    def step(self, active: ActiveNotice):
+        """
+        Загружаем очередную пачку рассылки, после последней подтверждаем сообщение notice.
+        Если пока пачка собиралась, очередь транспорта переполнилась - пачка ждет в active.pending,
+        а ETL не блокируется: рассылку снова выберут, когда очередь разгрузится (см. run)
+        """
+        try:
+            batch = active.pending or next(active.batches, None)
+            active.pending = None
+            if batch is not None:
+                if self.loader.is_paused(batch.transport):
+                    active.pending = batch
+                    return
+                self.loader.load_batch(batch)
+                return
+        except LoadError as err:
+            # подтвержденные сообщения уже отмечены, остальные уйдут при повторной обработке
+            logging.error("notice:{0} not loaded: {1}".format(active.notice.notice_id, err))
+            self.finish(active, done=False)
+            return
+        except InvalidNoticeError as err:
+            # повтор не поможет - подтверждаем, чтобы рассылка не возвращалась в очередь бесконечно
+            logging.error("notice:{0} rejected: {1}".format(active.notice.notice_id, err))
+            self.finish(active, done=True)
+            return
+
+        # если в процессе ничего не упало - сбрасываем отметки в redis и считаем что задание выполнено
+        self.finish(active, done=True)
+
+    def finish(self, active: ActiveNotice, done: bool):
+        self.scheduler.remove(active)
+        active.batches.close()
+        flush_marks()
+        if done:
+            self.extractor.mark_done(active.delivery_tag)
+        else:
+            self.extractor.mark_failed(active.delivery_tag)
+
     def run(self):
         self.is_run = True
+        stats_logged_at = time.monotonic()
         while self.is_run:
-            data = self.extractor.get_data()
-            if not data:
-                time.sleep(0.1)
+            if time.monotonic() - stats_logged_at >= settings.STATS_LOG_INTERVAL:
+                self.report_stats()
+                stats_logged_at = time.monotonic()
+
+            # добираем рассылки, пока есть место. если в работе уже что-то есть - новых не ждем
+            while not self.scheduler.is_full():
+                data = self.extractor.get_data(wait=not self.scheduler)
+                if not data:
+                    break
+                self.admit(data, self.extractor.current_delivery_tag)
+
+            # рассылки, чьи очереди переполнены, ждут, остальные продолжаются.
+            # когда ждут все, новые рассылки не берутся - scheduler заполнен
+            active = self.scheduler.next(ready=lambda item: not self.loader.is_paused(item.notice.transport))
+            if active is None:
+                if self.scheduler:
+                    self.loader.connection.sleep(settings.BACKPRESSURE_INTERVAL)
+                # в режиме consume ожидание уже было внутри get_data
+                elif not self.extractor.consumer:
+                    time.sleep(0.1)
                 continue
-
-            transformed_data = self.transformer.transform(data)
-
-            self.loader.load(transformed_data)
-
-            # если в процессе ничего не упало - считаем что задание выполнено
-            self.extractor.mark_done()
+            self.step(active)
+
+        # недоделанные рассылки возвращаем в очередь, продолжатся с контрольной точки
+        for active in list(self.scheduler.active):
+            self.finish(active, done=False)
+        self.extractor.close()
+        self.transformer.close()
+        self.report_stats()
@@ -0,0 +1,10 @@
+class LoadError(Exception):
+    """Брокер не подтвердил прием сообщений. Задание нужно вернуть в очередь и обработать заново"""
+
+
+class AudienceError(LoadError):
+    """Не удалось получить получателей аудитории из auth. Задание нужно вернуть в очередь и обработать заново"""
+
+
+class InvalidNoticeError(Exception):
+    """Рассылка некорректна (например auth не принял аудиторию), повтор не поможет. Задание выбрасывается"""
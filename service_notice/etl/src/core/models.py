@@ -1,4 +1,5 @@
 import datetime
+from typing import Iterable, Iterator, Sequence
 from uuid import UUID
 
 import orjson
@@ -19,16 +20,96 @@ class CoreModel(BaseModel):
         allow_population_by_field_name = True
 
 
+class UserIds(Sequence[UUID]):
+    """
+    Получатели рассылки в компактном виде: 16 байт на получателя одной строкой байт.
+    UUID создаются только при чтении, срез - тоже UserIds без копирования в UUID.
+    Тип поля pydantic: принимает UserIds или список UUID/их текстового вида, в json - список
+    """
+
+    __slots__ = ("data",)
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value) -> "UserIds":
+        if isinstance(value, UserIds):
+            return value
+        if not isinstance(value, (list, tuple)):
+            raise TypeError("user ids must be a list")
+        return cls.parse(value)
+
+    def __init__(self, data: bytes = b""):
+        if len(data) % 16:
+            raise ValueError("user ids data must be a multiple of 16 bytes")
+        self.data = data
+
+    @classmethod
+    def parse(cls, items: Iterable[UUID | str]) -> "UserIds":
+        """Из UUID или их текстового вида. Текст разбирается без создания UUID"""
+        return cls(b"".join(item.bytes if isinstance(item, UUID) else uuid_bytes(item) for item in items))
+
+    def to_list(self) -> list[UUID]:
+        return list(self)
+
+    def __len__(self) -> int:
+        return len(self.data) // 16
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return UserIds.parse(self[i] for i in range(start, stop, step))
+            return UserIds(self.data[start * 16 : stop * 16])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("user ids index out of range")
+        return UUID(bytes=self.data[index * 16 : index * 16 + 16])
+
+    def __iter__(self) -> Iterator[UUID]:
+        data = self.data
+        return (UUID(bytes=data[i : i + 16]) for i in range(0, len(data), 16))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, UserIds):
+            return self.data == other.data
+        return list(self) == other
+
+    def __repr__(self) -> str:
+        return f"UserIds({len(self)})"
+
+
+def uuid_bytes(value: str) -> bytes:
+    """16 байт UUID из текста вида 8-4-4-4-12 или 32 hex-цифр"""
+    try:
+        data = bytes.fromhex(value.replace("-", ""))
+    except (AttributeError, ValueError):
+        data = b""
+    if len(data) != 16:
+        raise ValueError(f"{value} is not UUID")
+    return data
+
+
 class Notice(CoreModel):
     x_request_id: str | None  # для трассировки сообщений
     notice_id: UUID  # id сообщения
-    users_id: list[UUID]  # список на рассылку, может быть 1
+    # список на рассылку, может быть 1. получатели не проверяются pydantic поштучно, а сразу складываются
+    # в UserIds (из msgpack, см. core.codec, они уже приходят так) - на больших рассылках это основное время и память
+    users_id: UserIds = Field(default_factory=UserIds)
+    audience: str | None = None  # аудитория вместо списка: "all" или "role:<name>", получатели берутся из auth
     template_id: UUID  # шаблон сообщения
     extra: dict = Field(default_factory=dict)  # дополнительные поля для сообщения
     transport: str  # транспорт - 'mail', 'sms', 'ws', 'push',....
     msg_type: str  # 'info', 'promo', ....
     priority: int = 0  #
     expire_at: datetime.datetime  #
+    parent_id: UUID | None = None  # id исходной рассылки, если это ее часть (см. Splitter)
+
+    class Config:
+        json_encoders = {UserIds: UserIds.to_list}
 
     @validator("x_request_id")
     def validate_request_id(cls, value):
@@ -52,14 +133,19 @@ class Message(CoreModel):
     user_id: UUID  #
     user_tz: str  #
     msg_meta: dict  #
-    msg_body: str  #
+    msg_body: str  # пустое, если тело лежит в redis (claim-check)
     expire_at: datetime.datetime  #
+    msg_body_ref: str | None = None  # ключ тела в redis
 
 
 class UserInfo(CoreModel):
+    # auth отдает только запрошенные поля, остальные остаются по умолчанию
     user_id: UUID
-    email: str | None
-    phone: str | None
-    username: str
+    email: str | None = None
+    phone: str | None = None
+    username: str | None = None
     time_zone: str = "UTC"
     reject_notice: list[str] = Field(default_factory=list)
+
+
+USER_FIELDS = frozenset(UserInfo.__fields__)
@@ -0,0 +1,83 @@
+import time
+from typing import Awaitable, Callable
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше burst про запас.
+    take не отказывает, а резервирует токены в долг и возвращает, сколько секунд нужно подождать
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, count: int = 1) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - count
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class RateLimiter:
+    """
+    Ограничение скорости постановки сообщений в очереди транспортов.
+    limits - сообщений в секунду по ключу "транспорт" или "транспорт:приоритет", второй точнее.
+    Запас (burst) - burst секунд работы на полной скорости.
+    Общий для всех экземпляров ETL лимит считается в redis: токены берутся оттуда сразу по lease штук
+    и тратятся локально, чтобы не ходить в redis на каждое сообщение
+    """
+
+    def __init__(self, limits: dict[str, float], burst: float = 1, lease: int = 1):
+        self.limits = {key: rate for key, rate in limits.items() if rate > 0}
+        self.burst = burst
+        self.lease = max(lease, 1)
+        self.buckets = {key: TokenBucket(rate, rate * burst) for key, rate in self.limits.items()}
+        # токены, уже полученные из redis, но еще не потраченные
+        self.leased: dict[str, int] = {}
+
+    def get_key(self, transport: str, priority: int) -> str | None:
+        key = f"{transport}:{priority}"
+        if key in self.limits:
+            return key
+        return transport if transport in self.limits else None
+
+    def acquire(
+        self, transport: str, priority: int, take: Callable[[str, float, float, int], float] | None = None
+    ) -> float:
+        """
+        Берем токен на одно сообщение, возвращаем задержку в секундах перед отправкой.
+        take(key, rate, burst, count) - общее ведро в redis, без него ограничение только в процессе
+        """
+        key = self.get_key(transport, priority)
+        if key is None:
+            return 0
+        if take is None:
+            return self.buckets[key].take()
+        if self.use_leased(key):
+            return 0
+        return take(key, self.limits[key], self.limits[key] * self.burst, self.lease)
+
+    async def acquire_async(
+        self, transport: str, priority: int, take: Callable[[str, float, float, int], Awaitable[float]] | None = None
+    ) -> float:
+        """См. acquire, take - корутина"""
+        key = self.get_key(transport, priority)
+        if key is None:
+            return 0
+        if take is None:
+            return self.buckets[key].take()
+        if self.use_leased(key):
+            return 0
+        return await take(key, self.limits[key], self.limits[key] * self.burst, self.lease)
+
+    def use_leased(self, key: str) -> bool:
+        """Тратим токен из полученных ранее. False - нужна новая аренда, ее первый токен уже учтен"""
+        left = self.leased.get(key, 0)
+        if left > 0:
+            self.leased[key] = left - 1
+            return True
+        self.leased[key] = self.lease - 1
+        return False
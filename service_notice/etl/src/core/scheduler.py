@@ -0,0 +1,57 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
+
+from core.models import Notice
+
+
+@dataclass(eq=False)
+class ActiveNotice:
+    """Рассылка в работе: сообщение из очереди notice и генератор ее пачек"""
+
+    notice: Notice
+    delivery_tag: int
+    batches: Iterator
+    weight: int
+    current: int = 0
+    # собранная, но еще не загруженная пачка: очередь транспорта переполнена
+    pending: Any = None
+
+
+class Scheduler:
+    """
+    Очередность пачек нескольких рассылок, которые ETL обрабатывает одновременно (не больше capacity).
+    Обход взвешенный круговой (smooth weighted round-robin, как в nginx): вес рассылки - priority + 1,
+    рассылка с приоритетом 9 получает в 10 раз больше пачек, чем с приоритетом 0, но пачки идут вперемешку,
+    поэтому маленькая срочная рассылка не ждет, пока загрузится большая
+    """
+
+    def __init__(self, capacity: int = 1):
+        self.capacity = max(capacity, 1)
+        self.active: list[ActiveNotice] = []
+
+    def __len__(self) -> int:
+        return len(self.active)
+
+    def is_full(self) -> bool:
+        return len(self.active) >= self.capacity
+
+    def add(self, notice: Notice, delivery_tag: int, batches: Iterator) -> ActiveNotice:
+        active = ActiveNotice(notice, delivery_tag, batches, max(notice.priority, 0) + 1)
+        self.active.append(active)
+        return active
+
+    def remove(self, active: ActiveNotice):
+        self.active.remove(active)
+
+    def next(self, ready: Callable[[ActiveNotice], bool] | None = None) -> ActiveNotice | None:
+        """Рассылка, чья пачка обрабатывается следующей. ready - выбирать только из тех, что готовы"""
+        candidates = [active for active in self.active if ready is None or ready(active)]
+        if not candidates:
+            return None
+        total = 0
+        for active in candidates:
+            active.current += active.weight
+            total += active.weight
+        chosen = max(candidates, key=lambda item: item.current)
+        chosen.current -= total
+        return chosen
@@ -0,0 +1,66 @@
+import threading
+from typing import Callable, Iterable
+
+# ключ снимка с текущими значениями
+GAUGES = "gauges"
+
+
+class Stats:
+    """
+    Счетчики и текущие значения ETL.
+    Счетчики (incr) копятся, текущие значения (set, например размер пачки или глубина очереди) перезаписываются
+    и в снимке лежат отдельно, под ключом gauges.
+    Кроме собственных значений можно зарегистрировать источник - функцию, возвращающую словарь
+    (например статистику кэша), он будет опрошен при снятии снимка
+    """
+
+    def __init__(self):
+        self.values: dict[str, int | float] = {}
+        self.gauges: dict[str, int | float] = {}
+        self.sources: dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, value: int | float = 1):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name: str, value: int | float):
+        self.gauges[name] = value
+
+    def register(self, name: str, source: Callable[[], dict]):
+        self.sources[name] = source
+
+    def snapshot(self) -> dict:
+        result = dict(self.values)
+        if self.gauges:
+            result[GAUGES] = dict(self.gauges)
+        for name, source in self.sources.items():
+            result[name] = source()
+        return result
+
+
+stats = Stats()
+
+
+def merge_stats(snapshots: Iterable[dict]) -> dict:
+    """
+    Складывает снимки статистики нескольких процессов. Доля попаданий в кэш пересчитывается.
+    Текущие значения не складываются, берется наибольшее: например, глубину одной и той же очереди видят все процессы
+    """
+    result = {}
+    gauges = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            if name == GAUGES:
+                for gauge, gauge_value in value.items():
+                    gauges[gauge] = max(gauges.get(gauge, gauge_value), gauge_value)
+            elif isinstance(value, dict):
+                result[name] = merge_stats([result.get(name, {}), value])
+            elif isinstance(value, (int, float)):
+                result[name] = result.get(name, 0) + value
+    if "hits" in result and "misses" in result:
+        total = result["hits"] + result["misses"]
+        result["hit_rate"] = round(result["hits"] / total, 3) if total else 0.0
+    if gauges:
+        result[GAUGES] = gauges
+    return result
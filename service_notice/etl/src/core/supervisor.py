@@ -0,0 +1,96 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from typing import Callable
+
+from core.stats import merge_stats
+
+
+class Supervisor:
+    """
+    Запускает несколько процессов ETL и присматривает за ними.
+    Упавший процесс перезапускается, SIGTERM/SIGINT/SIGHUP пересылается процессам, чтобы они
+    доделали текущее задание и закрыли соединения. Процессы присылают снимки статистики
+    через очередь, супервизор периодически пишет в лог их сумму
+    """
+
+    def __init__(
+        self,
+        target: Callable[[int, multiprocessing.Queue], None],
+        workers: int,
+        restart_delay: float = 1,
+        stop_timeout: float = 60,
+        stats_interval: float = 60,
+    ):
+        # target(номер процесса, очередь статистики) - то, что выполняется в процессе
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.stats_interval = stats_interval
+        self.context = multiprocessing.get_context("fork")
+        self.stats_queue = self.context.Queue()
+        self.processes: dict[int, multiprocessing.Process] = {}
+        self.stats: dict[int, dict] = {}
+        self.is_run = False
+
+    def start_worker(self, number: int):
+        process = self.context.Process(
+            target=self.target, args=(number, self.stats_queue), name=f"etl-worker-{number}", daemon=False
+        )
+        process.start()
+        self.processes[number] = process
+        logging.info("started etl worker {0} pid:{1}".format(number, process.pid))
+
+    def stop(self, sig_no: int = signal.SIGTERM, *args):
+        if not self.is_run:
+            return
+        self.is_run = False
+        logging.info("stop etl workers")
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    def collect_stats(self, timeout: float):
+        try:
+            number, snapshot = self.stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self.stats[number] = snapshot
+
+    def check_workers(self):
+        for number, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            logging.error("etl worker {0} pid:{1} exited with code {2}".format(number, process.pid, process.exitcode))
+            time.sleep(self.restart_delay)
+            if self.is_run:
+                self.start_worker(number)
+
+    def run(self):
+        self.is_run = True
+        for number in range(self.workers):
+            self.start_worker(number)
+
+        stats_logged_at = time.monotonic()
+        while self.is_run:
+            self.collect_stats(timeout=1)
+            if not self.is_run:
+                break
+            self.check_workers()
+            if time.monotonic() - stats_logged_at >= self.stats_interval:
+                logging.info("etl stats ({0} workers): {1}".format(self.workers, merge_stats(self.stats.values())))
+                stats_logged_at = time.monotonic()
+
+        # пока процессы завершаются, разбираем очередь: иначе процесс может повиснуть на записи в нее
+        deadline = time.monotonic() + self.stop_timeout
+        while time.monotonic() < deadline and any(process.is_alive() for process in self.processes.values()):
+            self.collect_stats(timeout=0.1)
+        for process in self.processes.values():
+            if process.is_alive():
+                logging.error("etl worker pid:{0} did not stop in time, kill".format(process.pid))
+                process.kill()
+            process.join()
+        logging.info("etl stats ({0} workers): {1}".format(self.workers, merge_stats(self.stats.values())))
@@ -1,6 +1,73 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
 from datetime import datetime
+from typing import Callable, Iterable, Iterator, TypeVar
+
+from core.constants import EXPIRE_HEADER
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 def get_ttl_from_datetime(dt: datetime) -> int:
     """Возвращает разницу между переданной меткой и текущим временем"""
     return int(dt.timestamp() - datetime.utcnow().timestamp())
+
+
+def is_expired(headers: dict | None) -> bool:
+    """Рассылка просрочена по заголовку EXPIRE_HEADER. Без заголовка (старые отправители) - не известно, False"""
+    expire_at = (headers or {}).get(EXPIRE_HEADER)
+    return expire_at is not None and expire_at < time.time()
+
+
+def expire_headers(expire_at: datetime) -> dict:
+    return {EXPIRE_HEADER: int(expire_at.timestamp())}
+
+
+def prefetch_map(func: Callable[[T], R], items: Iterable[T], depth: int, executor: Executor | None) -> Iterator[R]:
+    """
+    Как map, но держит в работе до depth вызовов func наперед.
+    Пока потребитель обрабатывает очередной результат, следующие уже выполняются в executor.
+    Результаты отдаются в порядке items. При depth=0 работает как обычный map
+    """
+    if depth <= 0 or executor is None:
+        yield from map(func, items)
+        return
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class AdaptiveBatchSize:
+    """
+    Размер пачки, который подстраивается под задержку ответа (AIMD).
+    Пока пачка обрабатывается быстрее target_latency с запасом - размер растет на step,
+    если медленнее target_latency или с ошибкой - уменьшается вдвое. Размер всегда в [min_size, max_size]
+    """
+
+    def __init__(self, initial: int, min_size: int, max_size: int, target_latency: float, step: int):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.step = step
+        self.size = max(min_size, min(initial, max_size))
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> int:
+        return self.size
+
+    def observe(self, latency: float, ok: bool = True) -> int:
+        with self._lock:
+            if not ok or latency > self.target_latency:
+                self.size = max(self.min_size, self.size // 2)
+            elif latency < self.target_latency * 0.7:
+                self.size = min(self.max_size, self.size + self.step)
+            return self.size
@@ -0,0 +1,113 @@
+import logging
+import time
+from http import HTTPStatus
+from uuid import UUID
+
+import aiohttp
+import backoff
+import orjson
+
+from core.constants import Mark
+from core.exceptions import AudienceError, InvalidNoticeError
+from core.models import UserInfo
+from core.stats import stats
+from core.utils import AdaptiveBatchSize
+from db.auth_api import get_request_data, parse_audience_page, parse_response
+
+# ответы auth, при которых запрос имеет смысл повторить
+RETRY_STATUSES = (HTTPStatus.BAD_GATEWAY, HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT)
+
+
+def is_fatal(err: Exception) -> bool:
+    return isinstance(err, aiohttp.ClientResponseError) and err.status not in RETRY_STATUSES
+
+
+class AsyncAuthAPI:
+    """Асинхронный клиент auth сервиса: пул соединений aiohttp, таймауты и повторы с backoff"""
+
+    def __init__(
+        self,
+        uri: str,
+        path: str,
+        secret_key: str,
+        pool_size: int = 10,
+        connect_timeout: float = 3,
+        read_timeout: float = 10,
+        retries: int = 3,
+        batch_size: AdaptiveBatchSize | None = None,
+        audience_path: str = "/auth/v1/audience",
+    ):
+        self.url = f"http://{uri}{path}"
+        self.audience_url = f"http://{uri}{audience_path}"
+        self.secret_key = secret_key
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.session: aiohttp.ClientSession | None = None
+        self.batch_size = batch_size or AdaptiveBatchSize(100, 100, 100, read_timeout, 0)
+        stats.set("auth_batch_size", self.batch_size.value)
+
+    async def connect(self):
+        logging.debug("start async auth api client")
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=self.timeout,
+            headers={"Authorization": self.secret_key, "Content-Type": "application/json"},
+        )
+
+    async def _post(self, url: str, request_id: str, data: dict) -> dict:
+        body = orjson.dumps(data)
+
+        @backoff.on_exception(backoff.expo, aiohttp.ClientError, max_tries=self.retries + 1, giveup=is_fatal)
+        async def post():
+            async with self.session.post(url, data=body, headers={"X-Request-Id": request_id}) as response:
+                response.raise_for_status()
+                return await response.json(loads=orjson.loads)
+
+        return await post()
+
+    async def get_users_info(
+        self,
+        request_id: str,
+        user_ids: list[UUID],
+        fields: frozenset[str] | None = None,
+        msg_type: str | None = None,
+        contact: str | None = None,
+    ) -> tuple[dict[UUID, UserInfo], dict[UUID, Mark]]:
+        """Параметры и ответ те же, что у AuthAPI.get_users_info"""
+        started = time.monotonic()
+        ok = False
+        result = {}, {}
+        try:
+            data = await self._post(self.url, request_id, get_request_data(user_ids, fields, msg_type, contact))
+        except (aiohttp.ClientError, ValueError) as err:
+            logging.error(f"error call auth service. Error: {err}")
+        else:
+            ok = True
+            result = parse_response(data)
+
+        stats.set("auth_batch_size", self.batch_size.observe(time.monotonic() - started, ok))
+        return result
+
+    async def get_audience_page(
+        self, request_id: str, audience: str, after: UUID | None = None, limit: int = 1000
+    ) -> tuple[list[UUID], UUID | None]:
+        """См. AuthAPI.get_audience_page"""
+        try:
+            data = {"audience": audience, "after": after, "limit": limit}
+            data = await self._post(self.audience_url, request_id, data)
+            return parse_audience_page(data)
+        except aiohttp.ClientResponseError as err:
+            if HTTPStatus.BAD_REQUEST <= err.status < HTTPStatus.INTERNAL_SERVER_ERROR:
+                raise InvalidNoticeError(f"auth rejected audience {audience}: {err.message}") from err
+            raise AudienceError(f"error get audience {audience} from auth service. Error: {err}") from err
+        except (aiohttp.ClientError, KeyError, ValueError) as err:
+            raise AudienceError(f"error get audience {audience} from auth service. Error: {err}") from err
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            logging.debug("close async auth api client")
+
+
+db: AsyncAuthAPI | None = None
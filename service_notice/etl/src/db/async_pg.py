@@ -0,0 +1,36 @@
+import datetime
+import logging
+from uuid import UUID
+
+import asyncpg
+import backoff
+
+
+class AsyncPostgresDB:
+    def __init__(self, uri: str, pool_size: int = 5):
+        self.uri = uri
+        self.pool_size = pool_size
+        self.pool: asyncpg.Pool | None = None
+
+    @backoff.on_exception(backoff.expo, (OSError, asyncpg.PostgresError), max_time=60)
+    async def connect(self):
+        logging.debug("start async PostgreSQL")
+        self.pool = await asyncpg.create_pool(self.uri, min_size=1, max_size=self.pool_size)
+
+    async def get_template(self, template_id: UUID) -> tuple[str, str, datetime.datetime | None]:
+        query = "select subject, body, modified from public.templates where id=$1"
+        row = await self.pool.fetchrow(query, template_id)
+        if row:
+            return row["subject"], row["body"], row["modified"]
+        return "", "", None
+
+    async def get_template_modified(self, template_id: UUID) -> datetime.datetime | None:
+        return await self.pool.fetchval("select modified from public.templates where id=$1", template_id)
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            logging.debug("close async PostgreSQL")
+
+
+db: AsyncPostgresDB | None = None
@@ -0,0 +1,118 @@
+import logging
+import time
+from typing import AsyncIterator
+from uuid import UUID
+
+import backoff
+from redis import asyncio as aioredis
+from redis.exceptions import ConnectionError
+
+from core.constants import Mark
+from db.storage import (
+    BITFIELD_CHUNK_SIZE,
+    MARK_BITS,
+    MARK_TO_CODE,
+    TAKE_TOKENS_SCRIPT,
+    Storage,
+    decode_checkpoint,
+    decode_marks,
+    encode_checkpoint,
+)
+
+
+class AsyncStorage:
+    """
+    Асинхронный вариант Storage для AsyncETL: тот же формат ключей и битовой карты отметок,
+    тот же буфер отложенной записи отметок
+    """
+
+    redis: aioredis.Redis
+
+    def __init__(self, uri: str, buffer_size: int = 500, flush_interval: float = 0.5):
+        self.uri = uri
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.marks: list[tuple[UUID, int, Mark, int]] = []
+        self.flushed_at = time.monotonic()
+
+    @backoff.on_exception(backoff.expo, ConnectionError, max_time=60)
+    async def connect(self):
+        logging.debug("start async Redis")
+        self.redis = aioredis.from_url(self.uri)
+        await self.redis.ping()
+        self.take_tokens_script = self.redis.register_script(TAKE_TOKENS_SCRIPT)
+
+    async def start_notice(self, notice_id: UUID, ttl=24 * 60 * 60) -> bool:
+        return bool(await self.redis.set(Storage.notice_key(notice_id), 1, ex=ttl, nx=True))
+
+    async def add_mark(self, notice_id: UUID, position: int, result: Mark, ttl: int):
+        self.marks.append((notice_id, position, result, ttl))
+        if len(self.marks) >= self.buffer_size or time.monotonic() - self.flushed_at >= self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        marks, self.marks = self.marks, []
+        self.flushed_at = time.monotonic()
+        if not marks:
+            return
+
+        by_notice: dict[UUID, list[tuple[int, Mark]]] = {}
+        ttls: dict[UUID, int] = {}
+        for notice_id, position, result, ttl in marks:
+            by_notice.setdefault(notice_id, []).append((position, result))
+            ttls[notice_id] = max(ttl, ttls.get(notice_id, 0))
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for notice_id, notice_marks in by_notice.items():
+                key = Storage.mark_key(notice_id)
+                for start in range(0, len(notice_marks), BITFIELD_CHUNK_SIZE):
+                    args = []
+                    for position, result in notice_marks[start : start + BITFIELD_CHUNK_SIZE]:
+                        args += ["SET", f"u{MARK_BITS}", f"#{position}", MARK_TO_CODE[result]]
+                    pipe.execute_command("BITFIELD", key, *args)
+                pipe.expire(key, ttls[notice_id])
+            await pipe.execute()
+        logging.debug("marked {0} messages".format(len(marks)))
+
+    async def iter_marks(
+        self, notice_id: UUID, count: int, chunk_size: int = 1000, start: int = 0
+    ) -> AsyncIterator[Mark | None]:
+        key = Storage.mark_key(notice_id)
+        per_byte = 8 // MARK_BITS
+        stored = min(count, await self.redis.strlen(key) * per_byte)
+        for chunk_start in range(start, stored, chunk_size):
+            chunk_count = min(chunk_size, stored - chunk_start)
+            data = await self.redis.getrange(key, chunk_start // per_byte, (chunk_start + chunk_count - 1) // per_byte)
+            for mark in decode_marks(data, chunk_start, chunk_count):
+                yield mark
+        for _ in range(max(start, stored), count):
+            yield None
+
+    async def set_checkpoint(self, notice_id: UUID, position: int, ttl=24 * 60 * 60, cursor: UUID | None = None):
+        await self.redis.set(Storage.checkpoint_key(notice_id), encode_checkpoint(position, cursor), ex=ttl)
+        logging.debug("checkpoint notice:{0} position:{1}".format(notice_id, position))
+
+    async def get_checkpoint(self, notice_id: UUID) -> tuple[int, UUID | None]:
+        return decode_checkpoint(await self.redis.get(Storage.checkpoint_key(notice_id)))
+
+    async def put_blob(self, body: bytes, ttl=24 * 60 * 60) -> str:
+        """См. Storage.put_blob"""
+        key = Storage.blob_key(body)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, body, ex=ttl, nx=True)
+            pipe.expire(key, ttl, gt=True)
+            await pipe.execute()
+        return key
+
+    async def take_tokens(self, key: str, rate: float, burst: float, count: int) -> float:
+        """См. Storage.take_tokens"""
+        return float(await self.take_tokens_script(keys=[Storage.rate_key(key)], args=[rate, burst, count]))
+
+    async def close(self):
+        if self.redis:
+            await self.flush()
+            await self.redis.close()
+            logging.debug("close async Redis")
+
+
+db: AsyncStorage | None = None
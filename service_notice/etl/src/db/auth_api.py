@@ -1,39 +1,177 @@
 import logging
+import time
 from http import HTTPStatus
 from uuid import UUID
 
 import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import JSONDecodeError, RequestException
+from urllib3.util.retry import Retry
 
-from core.config import settings
+from core.constants import REJECT_REASONS, Mark
+from core.exceptions import AudienceError, InvalidNoticeError
 from core.models import UserInfo
+from core.stats import stats
+from core.utils import AdaptiveBatchSize
 
 
-def get_users_info_from_auth(request_id: str, user_ids: list[UUID]) -> dict[UUID, UserInfo]:
-    auth_srv = settings.AUTH_SERVICE_URI
-    path = "/auth/v1/userinfo"
-    url = f"http://{auth_srv}{path}"
-    data = orjson.dumps({"user_ids": user_ids})
-    headers = {"Authorization": settings.SECRET_KEY, "X-Request-Id": request_id, "Content-Type": "application/json"}
+def get_request_data(
+    user_ids: list[UUID], fields: frozenset[str] | None, msg_type: str | None = None, contact: str | None = None
+) -> dict:
+    data = {"user_ids": user_ids}
+    if fields is not None:
+        data["fields"] = sorted(fields)
+    # фильтры доставки: отказавших auth вернет списками id в rejected
+    if msg_type is not None:
+        data["msg_type"] = msg_type
+    if contact is not None:
+        data["contact"] = contact
+    return data
 
-    try:
-        response = requests.post(url, headers=headers, data=data)
 
-    except RequestException as err:
-        logging.error(f"error call auth service. Error: {err}")
+def parse_response(data: dict) -> tuple[dict[UUID, UserInfo], dict[UUID, Mark]]:
+    users = {}
+    for item in data.get("users_info") or []:
+        user_info = UserInfo(**item)
+        users[user_info.user_id] = user_info
+    rejected = {}
+    for reason, user_ids in (data.get("rejected") or {}).items():
+        if (mark := REJECT_REASONS.get(reason)) is not None:
+            rejected.update((UUID(user_id), mark) for user_id in user_ids)
+    return users, rejected
 
-    else:
-        if response.status_code == HTTPStatus.OK:
-            try:
-                data = response.json()
 
-            except JSONDecodeError as err:
-                logging.error(f"error call auth service. Error: {err}")
+def parse_audience_page(data: dict) -> tuple[list[UUID], UUID | None]:
+    next_after = data.get("next")
+    return [UUID(user_id) for user_id in data["user_ids"]], UUID(next_after) if next_after else None
 
-            else:
-                if users_info := data.get("users_info"):
-                    result = {item["user_id"]: UserInfo(**item) for item in users_info}
-                    return result
 
-    return {}
+class AuthAPI:
+    """
+    Клиент auth сервиса.
+    Одна сессия на все время работы: соединения держатся в пуле и переиспользуются (keep-alive),
+    упавшие запросы повторяются с экспоненциальной задержкой
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        path: str,
+        secret_key: str,
+        pool_size: int = 10,
+        connect_timeout: float = 3,
+        read_timeout: float = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.3,
+        batch_size: AdaptiveBatchSize | None = None,
+        audience_path: str = "/auth/v1/audience",
+    ):
+        logging.debug("start auth api client")
+        self.url = f"http://{uri}{path}"
+        self.audience_url = f"http://{uri}{audience_path}"
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(HTTPStatus.BAD_GATEWAY, HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT),
+            # запрос userinfo только читает данные, его безопасно повторять
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Authorization": secret_key, "Content-Type": "application/json"})
+        # размер пачки подстраивается под время ответа auth
+        self.batch_size = batch_size or AdaptiveBatchSize(100, 100, 100, read_timeout, 0)
+        stats.set("auth_batch_size", self.batch_size.value)
+
+    def get_users_info(
+        self,
+        request_id: str,
+        user_ids: list[UUID],
+        fields: frozenset[str] | None = None,
+        msg_type: str | None = None,
+        contact: str | None = None,
+    ) -> tuple[dict[UUID, UserInfo], dict[UUID, Mark]]:
+        """fields - какие поля UserInfo вернуть, None - все. Возвращает найденных и отказавших с причиной"""
+        data = orjson.dumps(get_request_data(user_ids, fields, msg_type, contact))
+        headers = {"X-Request-Id": request_id}
+        started = time.monotonic()
+        ok = False
+        result = {}, {}
+
+        try:
+            response = self.session.post(self.url, headers=headers, data=data, timeout=self.timeout)
+
+        except RequestException as err:
+            logging.error(f"error call auth service. Error: {err}")
+
+        else:
+            if response.status_code == HTTPStatus.OK:
+                try:
+                    data = response.json()
+
+                except JSONDecodeError as err:
+                    logging.error(f"error call auth service. Error: {err}")
+
+                else:
+                    ok = True
+                    result = parse_response(data)
+
+        stats.set("auth_batch_size", self.batch_size.observe(time.monotonic() - started, ok))
+        return result
+
+    def get_audience_page(
+        self, request_id: str, audience: str, after: UUID | None = None, limit: int = 1000
+    ) -> tuple[list[UUID], UUID | None]:
+        """Страница получателей аудитории и курсор следующей страницы (None - страниц больше нет)"""
+        data = orjson.dumps({"audience": audience, "after": after, "limit": limit})
+        try:
+            response = self.session.post(
+                self.audience_url, headers={"X-Request-Id": request_id}, data=data, timeout=self.timeout
+            )
+            if HTTPStatus.BAD_REQUEST <= response.status_code < HTTPStatus.INTERNAL_SERVER_ERROR:
+                raise InvalidNoticeError(f"auth rejected audience {audience}: {response.text}")
+            response.raise_for_status()
+            return parse_audience_page(response.json())
+        except (RequestException, KeyError, ValueError) as err:
+            raise AudienceError(f"error get audience {audience} from auth service. Error: {err}") from err
+
+    def close(self):
+        if self.session:
+            self.session.close()
+            logging.debug("close auth api client")
+
+
+db: AuthAPI | None = None
+
+
+def get_users_info_from_auth(
+    request_id: str,
+    user_ids: list[UUID],
+    fields: frozenset[str] | None = None,
+    msg_type: str | None = None,
+    contact: str | None = None,
+) -> tuple[dict[UUID, UserInfo], dict[UUID, Mark]]:
+    if db:
+        return db.get_users_info(request_id, user_ids, fields, msg_type, contact)
+    return {}, {}
+
+
+def get_audience_page_from_auth(
+    request_id: str, audience: str, after: UUID | None = None, limit: int = 1000
+) -> tuple[list[UUID], UUID | None]:
+    if db:
+        return db.get_audience_page(request_id, audience, after, limit)
+    return [], None
+
+
+def get_batch_size(default: int = 100) -> int:
+    """Текущий размер пачки для запросов к auth"""
+    if db:
+        return db.batch_size.value
+    return default
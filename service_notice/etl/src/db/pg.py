@@ -1,3 +1,4 @@
+import datetime
 import logging
 
 import backoff
@@ -36,10 +37,20 @@ class PostgresDB:
 db: PostgresDB | None = None
 
 
-def get_template_from_db(template_id: str) -> tuple[str, str]:
-    query = "select subject, body from public.templates where id='{0}'"
+def get_template_from_db(template_id: str) -> tuple[str, str, datetime.datetime | None]:
+    query = "select subject, body, modified from public.templates where id='{0}'"
     result = db.execute_query(query.format(template_id))
     if result:
-        return result[0]
+        return tuple(result[0])
     else:
-        return "", ""
+        return "", "", None
+
+
+def get_template_modified(template_id: str) -> datetime.datetime | None:
+    """Время последнего изменения шаблона в админке - дешевая проверка актуальности кэша"""
+    query = "select modified from public.templates where id='{0}'"
+    result = db.execute_query(query.format(template_id))
+    if result:
+        return result[0][0]
+    else:
+        return None
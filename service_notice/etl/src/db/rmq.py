@@ -1,8 +1,12 @@
 import logging
+from typing import Callable
 
 import backoff
 import pika
-from pika.exceptions import AMQPConnectionError
+from pika.exceptions import AMQPConnectionError, AMQPError
+
+# версии pika, с которыми проверен ConfirmChannel: он использует внутренний BlockingChannel._impl
+CONFIRM_CHANNEL_PIKA_VERSIONS = ("1.3.", "1.4.")
 
 
 class RabbitMQ:
@@ -19,4 +23,53 @@ class RabbitMQ:
             logging.debug("close rabbitmq")
 
 
+class ConfirmChannel:
+    """
+    Канал BlockingConnection с асинхронными подтверждениями публикаций (publisher confirms).
+    BlockingChannel в режиме подтверждений ждет ответ брокера на каждое сообщение, поэтому подтверждения
+    включаются и сообщения публикуются на нижележащем асинхронном канале BlockingChannel._impl
+    (pika.channel.Channel). Это не публичный API pika, поэтому версия проверяется при создании канала.
+    on_confirm вызывается с фреймом Basic.Ack или Basic.Nack, пока соединение обрабатывает события
+    """
+
+    def __init__(self, connection: pika.BlockingConnection, on_confirm: Callable[[pika.frame.Method], None]):
+        if not pika.__version__.startswith(CONFIRM_CHANNEL_PIKA_VERSIONS):
+            raise RuntimeError(
+                "publisher confirms are not supported with pika {0}, use confirm=False or pika {1}x".format(
+                    pika.__version__, "x, ".join(CONFIRM_CHANNEL_PIKA_VERSIONS)
+                )
+            )
+        self.connection = connection
+        self.on_confirm = on_confirm
+        self.channel: pika.adapters.blocking_connection.BlockingChannel | None = None
+        # номер последнего опубликованного сообщения, брокер подтверждает сообщения по этим номерам
+        self.delivery_tag = 0
+        self.open()
+
+    def open(self):
+        self.channel = self.connection.channel()
+        self.delivery_tag = 0
+        selected = []
+        self.channel._impl.confirm_delivery(ack_nack_callback=self.on_confirm, callback=selected.append)
+        while not selected:
+            self.connection.process_data_events(time_limit=1)
+
+    def reopen(self):
+        """
+        Новый канал вместо старого, например когда подтверждения не пришли.
+        Номера сообщений нового канала начинаются заново, подтверждения старого больше не придут
+        """
+        try:
+            self.channel.close()
+        except AMQPError as err:
+            logging.warning("can't close rabbitmq channel: {0}".format(err))
+        self.open()
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties: pika.BasicProperties):
+        self.channel._impl.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        self.delivery_tag += 1
+        # отдаем данные в сокет и забираем пришедшие подтверждения, не блокируясь
+        self.connection.process_data_events(time_limit=0)
+
+
 db: RabbitMQ | None = None
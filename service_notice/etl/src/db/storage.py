@@ -1,4 +1,7 @@
+import hashlib
 import logging
+import time
+from typing import Iterator
 from uuid import UUID
 
 import backoff
@@ -7,39 +10,207 @@ from redis.exceptions import ConnectionError
 
 from core.constants import Mark
 
+# на каждого получателя уходит 2 бита, 0 - отметки нет.
+# SENT в ETL не выставляется, а повтор (DUPLICATE) обрабатывать не нужно, как и уже поставленное в очередь,
+# поэтому в битовой карте оба хранятся так же как QUEUED
+MARK_BITS = 2
+MARK_TO_CODE = {Mark.REJECTED_USER: 1, Mark.REJECTED_NODATA: 2, Mark.QUEUED: 3, Mark.SENT: 3, Mark.DUPLICATE: 3}
+CODE_TO_MARK = {1: Mark.REJECTED_USER, 2: Mark.REJECTED_NODATA, 3: Mark.QUEUED}
+# сколько операций SET отправлять в одной команде BITFIELD
+BITFIELD_CHUNK_SIZE = 1000
+
+
+def decode_marks(data: bytes, start: int, count: int) -> list[Mark | None]:
+    """
+    Раскладываем байты битовой карты на отметки.
+    data - байты карты, начиная с байта, в котором лежит позиция start
+    """
+    per_byte = 8 // MARK_BITS
+    result = []
+    for position in range(start, start + count):
+        byte_index = position // per_byte - start // per_byte
+        if byte_index >= len(data):
+            result.append(None)
+            continue
+        # BITFIELD нумерует биты от старшего к младшему
+        shift = 8 - MARK_BITS * (position % per_byte + 1)
+        code = (data[byte_index] >> shift) & 0b11
+        result.append(CODE_TO_MARK.get(code))
+    return result
+
+
+# общее ведро токенов (см. core.ratelimit): резервируем count токенов, возвращаем задержку в секундах.
+# время берем у redis, чтобы часы экземпляров ETL не влияли на результат
+TAKE_TOKENS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate) - count
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil((burst - tokens) / rate) + 60)
+if tokens >= 0 then
+    return "0"
+end
+return tostring(-tokens / rate)
+"""
+
+
+def encode_checkpoint(position: int, cursor: UUID | None) -> str:
+    return f"{position}:{cursor}" if cursor else str(position)
+
+
+def decode_checkpoint(value: bytes | None) -> tuple[int, UUID | None]:
+    """Позиция и курсор из значения контрольной точки вида позиция[:курсор]"""
+    if not value:
+        return 0, None
+    position, _, cursor = value.decode().partition(":")
+    return int(position), UUID(cursor) if cursor else None
+
+
+class MarkBuffer:
+    """
+    Буфер отметок с отложенной записью.
+    Отметки копятся в памяти и пишутся в redis одним pipeline, когда набралось size отметок
+    или с последней записи прошло больше interval секунд. Перед подтверждением задания
+    буфер нужно принудительно сбросить через flush
+    """
+
+    def __init__(self, storage: "Storage", size: int = 500, interval: float = 0.5):
+        self.storage = storage
+        self.size = size
+        self.interval = interval
+        self.marks: list[tuple[UUID, int, Mark, int]] = []
+        self.flushed_at = time.monotonic()
+
+    def add(self, notice_id: UUID, position: int, result: Mark, ttl: int):
+        self.marks.append((notice_id, position, result, ttl))
+        if len(self.marks) >= self.size or time.monotonic() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.marks:
+            self.storage.mark_processed_many(self.marks)
+            self.marks = []
+        self.flushed_at = time.monotonic()
+
 
 class Storage:
+    """
+    Хранилище отметок об обработке.
+    Для каждого сообщения хранится одна битовая карта: по 2 бита на получателя,
+    адресация по позиции получателя в Notice.users_id, один ttl на всю карту
+    """
+
     redis: redis.Redis
 
     @backoff.on_exception(backoff.expo, ConnectionError, max_time=60)
-    def __init__(self, uri: str):
+    def __init__(self, uri: str, buffer_size: int = 500, flush_interval: float = 0.5):
         logging.debug("start Redis")
         self.redis = redis.from_url(uri)
         self.redis.ping()
+        self.buffer = MarkBuffer(self, buffer_size, flush_interval)
+        self.take_tokens_script = self.redis.register_script(TAKE_TOKENS_SCRIPT)
+
+    @staticmethod
+    def notice_key(notice_id: UUID) -> str:
+        """ключ отметки о начале обработки сообщения"""
+        return f"notice:{notice_id}"
+
+    @staticmethod
+    def mark_key(notice_id: UUID) -> str:
+        """ключ битовой карты отметок по получателям"""
+        return f"notice:{notice_id}:marks"
+
+    @staticmethod
+    def checkpoint_key(notice_id: UUID) -> str:
+        """ключ контрольной точки: все получатели до этой позиции обработаны"""
+        return f"notice:{notice_id}:cursor"
 
     @staticmethod
-    def mark_key(notice_id: UUID, user_id: UUID) -> str:
-        """определяет ключ для хранения"""
-        return f"notice:{notice_id}:user:{user_id}"
+    def rate_key(key: str) -> str:
+        """ключ общего ведра токенов транспорта"""
+        return f"ratelimit:{key}"
+
+    @staticmethod
+    def blob_key(body: bytes) -> str:
+        """ключ тела сообщения (claim-check): одинаковые тела хранятся один раз"""
+        return f"blob:{hashlib.sha256(body).hexdigest()}"
+
+    def start_notice(self, notice_id: UUID, ttl=24 * 60 * 60) -> bool:
+        """Помечаем сообщение как взятое в работу. Возвращает False, если сообщение уже обрабатывалось"""
+        return bool(self.redis.set(self.notice_key(notice_id), 1, ex=ttl, nx=True))
 
-    def mark_processed(self, notice_id: UUID, user_id: UUID, result=Mark.QUEUED, ttl=24 * 60 * 60):
+    def mark_processed(self, notice_id: UUID, position: int, result=Mark.QUEUED, ttl=24 * 60 * 60):
         """Помечаем сообщение для пользователя как обработанное"""
-        key = self.mark_key(notice_id, user_id)
-        self.redis.set(key, result.value, ex=ttl)
-        logging.debug("marked notice:{0} user:{1} mark:{2}".format(notice_id, user_id, result.name))
+        self.mark_processed_many([(notice_id, position, result, ttl)])
 
-    def get_mark(self, notice_id: UUID, user_id: UUID) -> Mark | None:
-        """Получаем отметку или None если такое сообщение еше не встречалось"""
-        key = self.mark_key(notice_id, user_id)
-        value = self.redis.get(key)
-        if not value:
-            return None
+    def mark_processed_many(self, marks: list[tuple[UUID, int, Mark, int]]):
+        """Пишем пачку отметок (notice_id, position, result, ttl) за один проход по сети"""
+        by_notice: dict[UUID, list[tuple[int, Mark]]] = {}
+        ttls: dict[UUID, int] = {}
+        for notice_id, position, result, ttl in marks:
+            by_notice.setdefault(notice_id, []).append((position, result))
+            ttls[notice_id] = max(ttl, ttls.get(notice_id, 0))
 
-        value = int(value.decode("utf-8"))
-        return Mark(value)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for notice_id, notice_marks in by_notice.items():
+                key = self.mark_key(notice_id)
+                for start in range(0, len(notice_marks), BITFIELD_CHUNK_SIZE):
+                    operation = pipe.bitfield(key)
+                    for position, result in notice_marks[start : start + BITFIELD_CHUNK_SIZE]:
+                        operation.set(f"u{MARK_BITS}", f"#{position}", MARK_TO_CODE[result])
+                    operation.execute()
+                pipe.expire(key, ttls[notice_id])
+            pipe.execute()
+        logging.debug("marked {0} messages".format(len(marks)))
+
+    def get_marks(self, notice_id: UUID, start: int, count: int) -> list[Mark | None]:
+        """Получаем отметки для получателей с позициями [start, start + count)"""
+        if count <= 0:
+            return []
+        per_byte = 8 // MARK_BITS
+        data = self.redis.getrange(self.mark_key(notice_id), start // per_byte, (start + count - 1) // per_byte)
+        return decode_marks(data, start, count)
+
+    def iter_marks(self, notice_id: UUID, count: int, chunk_size: int = 1000, start: int = 0) -> Iterator[Mark | None]:
+        """
+        Отдаем отметки для позиций [start, count), читая карту кусками по chunk_size получателей.
+        За концом карты отметок нет, туда не ходим
+        """
+        stored = min(count, self.redis.strlen(self.mark_key(notice_id)) * (8 // MARK_BITS))
+        for chunk_start in range(start, stored, chunk_size):
+            yield from self.get_marks(notice_id, chunk_start, min(chunk_size, stored - chunk_start))
+        yield from (None for _ in range(max(start, stored), count))
+
+    def set_checkpoint(self, notice_id: UUID, position: int, ttl=24 * 60 * 60, cursor: UUID | None = None):
+        """cursor - последний обработанный получатель аудитории, с него продолжается выборка из auth"""
+        self.redis.set(self.checkpoint_key(notice_id), encode_checkpoint(position, cursor), ex=ttl)
+        logging.debug("checkpoint notice:{0} position:{1}".format(notice_id, position))
+
+    def get_checkpoint(self, notice_id: UUID) -> tuple[int, UUID | None]:
+        return decode_checkpoint(self.redis.get(self.checkpoint_key(notice_id)))
+
+    def put_blob(self, body: bytes, ttl=24 * 60 * 60) -> str:
+        """Сохраняем тело сообщения, возвращаем ключ. Если тело уже есть - только продлеваем ttl"""
+        key = self.blob_key(body)
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, body, ex=ttl, nx=True)
+            pipe.expire(key, ttl, gt=True)
+            pipe.execute()
+        return key
+
+    def take_tokens(self, key: str, rate: float, burst: float, count: int) -> float:
+        """Резервируем count токенов в общем ведре, возвращаем задержку в секундах"""
+        return float(self.take_tokens_script(keys=[self.rate_key(key)], args=[rate, burst, count]))
 
     def close(self):
         if self.redis:
+            self.buffer.flush()
             self.redis.close()
             logging.debug("close Redis")
 
@@ -47,13 +218,47 @@ class Storage:
 db: Storage | None = None
 
 
-def set_mark(notice_id, user_id, result=Mark.QUEUED, ttl=24 * 60 * 60):
+def start_notice(notice_id: UUID, ttl=24 * 60 * 60) -> bool:
+    if db:
+        return db.start_notice(notice_id, ttl)
+    return True
+
+
+def set_mark(notice_id: UUID, position: int, result=Mark.QUEUED, ttl=24 * 60 * 60):
+    if db:
+        db.buffer.add(notice_id, position, result, ttl)
+
+
+def flush_marks():
     if db:
-        db.mark_processed(notice_id, user_id, result, ttl)
+        db.buffer.flush()
 
 
-def get_mark(notice_id: UUID, user_id: UUID) -> Mark | None:
+def get_marks(notice_id: UUID, count: int, chunk_size: int = 1000, start: int = 0) -> Iterator[Mark | None]:
     if db:
-        return db.get_mark(notice_id, user_id)
+        yield from db.iter_marks(notice_id, count, chunk_size, start)
     else:
-        return None
+        yield from (None for _ in range(start, count))
+
+
+def set_checkpoint(notice_id: UUID, position: int, ttl=24 * 60 * 60, cursor: UUID | None = None):
+    if db:
+        db.set_checkpoint(notice_id, position, ttl, cursor)
+
+
+def get_checkpoint(notice_id: UUID) -> tuple[int, UUID | None]:
+    if db:
+        return db.get_checkpoint(notice_id)
+    return 0, None
+
+
+def put_blob(body: bytes, ttl=24 * 60 * 60) -> str | None:
+    if db:
+        return db.put_blob(body, ttl)
+    return None
+
+
+def take_tokens(key: str, rate: float, burst: float, count: int) -> float:
+    if db:
+        return db.take_tokens(key, rate, burst, count)
+    return 0
@@ -1,53 +1,175 @@
+import asyncio
 import logging
+import multiprocessing
+import os
+import signal
 
+import aio_pika
+import backoff
+
+import db.async_auth_api as db_async_auth
+import db.async_pg as db_async_pg
+import db.async_storage as db_async_redis
+import db.auth_api as db_auth
 import db.pg as db_pg
 import db.rmq as db_rmq
 import db.storage as db_redis
 from core import logging_config  # noqa
+from core.aetl import AsyncETL
 from core.config import settings
 from core.etl import ETL
+from core.supervisor import Supervisor
 from core.tracer import init_tracer
+from core.utils import AdaptiveBatchSize
 
 
 def set_quit_signal(callback):
     """Ловим сигналы на закрытие"""
-    import signal
-
     for sig in ("TERM", "HUP", "INT"):
         signal.signal(getattr(signal, "SIG" + sig), callback)
 
 
+def get_batch_size() -> AdaptiveBatchSize:
+    return AdaptiveBatchSize(
+        settings.AUTH_BATCH_SIZE,
+        settings.AUTH_BATCH_SIZE_MIN,
+        settings.AUTH_BATCH_SIZE_MAX,
+        settings.AUTH_BATCH_TARGET_MS / 1000,
+        settings.AUTH_BATCH_SIZE_STEP,
+    )
+
+
 def init_db():
     logging.info("Init DB...")
     # все подключения под backoff в классах
     db_rmq.db = db_rmq.RabbitMQ(settings.RABBITMQ_URI)
     db_pg.db = db_pg.PostgresDB(settings.PG_URI)
-    db_redis.db = db_redis.Storage(settings.REDIS_URI)
+    db_redis.db = db_redis.Storage(
+        settings.REDIS_URI, settings.MARKS_BUFFER_SIZE, settings.MARKS_FLUSH_INTERVAL_MS / 1000
+    )
+    db_auth.db = db_auth.AuthAPI(
+        settings.AUTH_SERVICE_URI,
+        settings.AUTH_API_PATH,
+        settings.SECRET_KEY,
+        pool_size=settings.AUTH_POOL_SIZE,
+        connect_timeout=settings.AUTH_CONNECT_TIMEOUT,
+        read_timeout=settings.AUTH_READ_TIMEOUT,
+        retries=settings.AUTH_RETRIES,
+        backoff_factor=settings.AUTH_RETRY_BACKOFF,
+        batch_size=get_batch_size(),
+        audience_path=settings.AUTH_AUDIENCE_PATH,
+    )
 
 
 def close_db():
     db_rmq.db.close()
     db_pg.db.close()
     db_redis.db.close()
+    db_auth.db.close()
+
+
+@backoff.on_exception(backoff.expo, (OSError, aio_pika.exceptions.AMQPConnectionError), max_time=60)
+async def connect_rmq() -> aio_pika.abc.AbstractRobustConnection:
+    return await aio_pika.connect_robust(settings.RABBITMQ_URI)
+
+
+async def init_async_db() -> aio_pika.abc.AbstractRobustConnection:
+    logging.info("Init async DB...")
+    db_async_pg.db = db_async_pg.AsyncPostgresDB(settings.PG_URI, settings.PG_POOL_SIZE)
+    db_async_redis.db = db_async_redis.AsyncStorage(
+        settings.REDIS_URI, settings.MARKS_BUFFER_SIZE, settings.MARKS_FLUSH_INTERVAL_MS / 1000
+    )
+    db_async_auth.db = db_async_auth.AsyncAuthAPI(
+        settings.AUTH_SERVICE_URI,
+        settings.AUTH_API_PATH,
+        settings.SECRET_KEY,
+        pool_size=settings.AUTH_POOL_SIZE,
+        connect_timeout=settings.AUTH_CONNECT_TIMEOUT,
+        read_timeout=settings.AUTH_READ_TIMEOUT,
+        retries=settings.AUTH_RETRIES,
+        batch_size=get_batch_size(),
+        audience_path=settings.AUTH_AUDIENCE_PATH,
+    )
+    await db_async_pg.db.connect()
+    await db_async_redis.db.connect()
+    await db_async_auth.db.connect()
+    return await connect_rmq()
+
+
+async def close_async_db(connection: aio_pika.abc.AbstractRobustConnection):
+    await db_async_redis.db.close()
+    await db_async_auth.db.close()
+    await db_async_pg.db.close()
+    await connection.close()
+
+
+async def run_async_etl(on_stats=None):
+    loop = asyncio.get_running_loop()
+    etl = AsyncETL(None, settings.ASYNC_CONCURRENCY, on_stats)
+    for sig in ("TERM", "HUP", "INT"):
+        loop.add_signal_handler(getattr(signal, "SIG" + sig), etl.stop)
+
+    etl.connection = await init_async_db()
+    if settings.ENABLE_TRACER:
+        init_tracer()
 
+    logging.info("start async notice etl, concurrency: {0}".format(settings.ASYNC_CONCURRENCY))
+    if not etl.stopped.is_set():
+        await etl.run()
+    logging.info("stop async notice etl")
 
-def main():
+    await close_async_db(etl.connection)
+
+
+def run_etl(number: int = 0, stats_queue: multiprocessing.Queue | None = None):
+    """Один экземпляр ETL со своими подключениями. В режиме нескольких процессов - тело процесса"""
+    on_stats = None
+    if stats_queue is not None:
+        on_stats = lambda snapshot: stats_queue.put((number, snapshot))  # noqa: E731
+
+    if settings.ETL_MODE == "async":
+        # до запуска цикла сигналы игнорируем, дальше их ловит сам цикл
+        set_quit_signal(signal.SIG_IGN)
+        asyncio.run(run_async_etl(on_stats))
+        return
+
+    etl = None
+    stopped = False
+
+    def on_quit(sig_no: int, *args):
+        nonlocal stopped
+        stopped = True
+        if etl:
+            etl.stop()
+
+    # ставим обработчик сразу, чтобы в процессе не сработал унаследованный от супервизора
+    set_quit_signal(on_quit)
     init_db()
 
     if settings.ENABLE_TRACER:
         init_tracer()
 
-    def on_quit(sig_no: int, *args):
-        etl.stop()
-
     logging.info("start notice etl")
-    etl = ETL(db_rmq.db)
-    set_quit_signal(on_quit)
-    etl.run()
+    etl = ETL(db_rmq.db, on_stats)
+    if not stopped:
+        etl.run()
     logging.info("stop notice etl")
 
     close_db()
 
 
+def main():
+    workers = settings.WORKERS or os.cpu_count()
+    if workers == 1:
+        run_etl()
+        return
+
+    logging.info("start notice etl supervisor, workers: {0}".format(workers))
+    supervisor = Supervisor(run_etl, workers, stats_interval=settings.STATS_LOG_INTERVAL)
+    set_quit_signal(supervisor.stop)
+    supervisor.run()
+    logging.info("stop notice etl supervisor")
+
+
 if __name__ == "__main__":
     main()
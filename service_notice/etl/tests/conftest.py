@@ -0,0 +1,29 @@
+import os
+import sys
+from pathlib import Path
+
+import fakeredis
+import pytest
+import redis
+
+BASE_DIR = Path(__file__).parent.parent
+
+src_path = BASE_DIR / "src/"
+if src_path not in sys.path:
+    sys.path.insert(1, str(src_path))
+
+# обязательные настройки, в тестах ни к чему не подключаемся
+for name in ("PG_URI", "AUTH_SERVICE_URI", "REDIS_URI", "RABBITMQ_URI"):
+    os.environ.setdefault(f"NOTICE_ETL_{name}", "test")
+
+import db.storage as storage  # noqa: E402
+
+
+@pytest.fixture
+def redis_storage(monkeypatch):
+    """Хранилище отметок на fakeredis вместо db.storage.db"""
+    monkeypatch.setattr(redis, "from_url", lambda uri: fakeredis.FakeRedis())
+    db = storage.Storage("redis://test", buffer_size=1)
+    monkeypatch.setattr(storage, "db", db)
+    yield db
+    db.redis.flushall()
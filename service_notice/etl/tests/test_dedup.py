@@ -0,0 +1,103 @@
+import datetime
+import uuid
+
+import pytest
+
+from core import etl
+from core.constants import Mark, Transport
+from core.models import Notice, UserInfo
+
+A, B, C = (uuid.UUID(int=number) for number in (1, 2, 3))
+
+
+@pytest.fixture
+def transformer(monkeypatch, redis_storage):
+    template = etl.compile_template(uuid.uuid4(), "subject", "body", None)
+    monkeypatch.setattr(etl, "get_template", lambda template_id: template)
+
+    def get_users_info(request_id, user_ids, fields, msg_type, contact):
+        return {user_id: UserInfo(user_id=user_id) for user_id in user_ids}, {}
+
+    monkeypatch.setattr(etl, "get_users_info", get_users_info)
+    return etl.Transformer()
+
+
+def make_notice(users_id: list[uuid.UUID]) -> Notice:
+    return Notice(
+        x_request_id="test",
+        notice_id=uuid.uuid4(),
+        users_id=users_id,
+        template_id=uuid.uuid4(),
+        transport=Transport.WEBSOCKET,
+        msg_type="info",
+        expire_at=datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(hours=1),
+    )
+
+
+def loaded(transformer: etl.Transformer, notice: Notice) -> list[tuple[int, uuid.UUID]]:
+    result = []
+    for batch in transformer.transform(notice):
+        result.extend((position, message.user_id) for position, message in batch.messages)
+    etl.flush_marks()
+    return result
+
+
+def test_drop_duplicates(transformer, redis_storage):
+    notice = make_notice([A, B, A, C, B])
+
+    assert loaded(transformer, notice) == [(0, A), (1, B), (3, C)]
+    # повторы помечены, в карте они хранятся как поставленные в очередь
+    assert redis_storage.get_marks(notice.notice_id, 0, 5) == [None, None, Mark.QUEUED, None, Mark.QUEUED]
+
+
+@pytest.mark.parametrize("checkpoint", [0, 2])
+def test_drop_duplicates_on_resume(checkpoint, transformer, redis_storage):
+    # первая обработка успела поставить в очередь A и B и упала до повтора A
+    notice = make_notice([A, B, A, C])
+    redis_storage.start_notice(notice.notice_id)
+    redis_storage.mark_processed(notice.notice_id, 0)
+    redis_storage.mark_processed(notice.notice_id, 1)
+    redis_storage.set_checkpoint(notice.notice_id, checkpoint)
+
+    assert loaded(transformer, notice) == [(3, C)]
+    assert redis_storage.get_marks(notice.notice_id, 2, 1) == [Mark.QUEUED]
+
+
+def test_resume_skips_marked_duplicates(transformer, redis_storage):
+    # повтор уже помечен, первое вхождение - нет: оно и отправляется
+    notice = make_notice([A, B, A, C])
+    redis_storage.start_notice(notice.notice_id)
+    redis_storage.mark_processed(notice.notice_id, 2, Mark.DUPLICATE)
+
+    assert loaded(transformer, notice) == [(0, A), (1, B), (3, C)]
+
+
+def test_resume_without_duplicates(transformer, redis_storage):
+    notice = make_notice([A, B, C])
+    redis_storage.start_notice(notice.notice_id)
+    redis_storage.mark_processed(notice.notice_id, 1, Mark.REJECTED_USER)
+    redis_storage.set_checkpoint(notice.notice_id, 1)
+
+    assert loaded(transformer, notice) == [(2, C)]
+
+
+def test_filter_processed_with_gaps(redis_storage):
+    notice_id = uuid.uuid4()
+    redis_storage.mark_processed(notice_id, 3)
+    redis_storage.mark_processed(notice_id, 7)
+    users = [(1, A), (3, B), (6, C), (7, A), (9, B)]
+
+    assert list(etl.filter_processed(notice_id, users)) == [(1, A), (6, C), (9, B)]
+    assert list(etl.filter_processed(notice_id, users, start=5)) == [(6, C), (9, B)]
+
+
+def test_split_drops_duplicates():
+    notice = make_notice([A, B, A, C, B])
+    splitter = etl.Splitter(chunk_size=2)
+
+    parts = list(splitter.split(notice))
+
+    assert [list(part.users_id) for part in parts] == [[A, B], [C]]
+    assert all(part.parent_id == notice.notice_id for part in parts)
+    # id частей не зависят от повторной доставки
+    assert [part.notice_id for part in parts] == [part.notice_id for part in splitter.split(notice)]
@@ -0,0 +1,33 @@
+from core.stats import GAUGES, Stats, merge_stats
+
+
+def test_snapshot_keeps_gauges_apart():
+    stats = Stats()
+    stats.incr("expired_notices")
+    stats.incr("expired_notices", 2)
+    stats.set("auth_batch_size", 100)
+    stats.set("auth_batch_size", 200)
+    stats.register("templates", lambda: {"hits": 3, "misses": 1})
+
+    assert stats.snapshot() == {
+        "expired_notices": 3,
+        GAUGES: {"auth_batch_size": 200},
+        "templates": {"hits": 3, "misses": 1},
+    }
+
+
+def test_merge_stats_sums_counters_only():
+    snapshots = [
+        {
+            "expired_notices": 1,
+            GAUGES: {"queue_depth_email": 500, "auth_batch_size": 100},
+            "cache": {"hits": 3, "misses": 1},
+        },
+        {"expired_notices": 2, GAUGES: {"queue_depth_email": 480}, "cache": {"hits": 1, "misses": 3}},
+    ]
+
+    assert merge_stats(snapshots) == {
+        "expired_notices": 3,
+        "cache": {"hits": 4, "misses": 4, "hit_rate": 0.5},
+        GAUGES: {"queue_depth_email": 500, "auth_batch_size": 100},
+    }
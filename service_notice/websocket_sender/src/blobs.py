@@ -0,0 +1,18 @@
+import logging
+
+from redis import asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """Тела сообщений, которые ETL положил в redis вместо очереди (claim-check)"""
+
+    def __init__(self, uri: str):
+        # подключение откроется при первом запросе
+        self.redis = aioredis.from_url(uri)
+
+    async def get(self, ref: str) -> str | None:
+        """Тело по ссылке из сообщения или None, если оно уже удалено по ttl"""
+        body = await self.redis.get(ref)
+        return body.decode() if body is not None else None
@@ -7,14 +7,18 @@ from aio_pika import connect
 from aio_pika.abc import AbstractIncomingMessage
 from aiormq import AMQPConnectionError
 from pydantic import ValidationError
+from redis.exceptions import RedisError
 from websockets.server import WebSocketServerProtocol
 
+import codec
 import logging_config  # noqa
+from blobs import BlobStore
 from config import settings
 from models import WebsocketNotification
 from utils import get_user_id
 
 ws_connections: dict[str, WebSocketServerProtocol] = {}
+blobs = BlobStore(settings.REDIS_URI)
 
 logger = logging.getLogger()
 
@@ -38,13 +42,24 @@ async def handler(ws: WebSocketServerProtocol):
 async def send_by_websocket(message: AbstractIncomingMessage) -> None:
     global ws_connections
     try:
-        notification = WebsocketNotification.parse_raw(message.body)
-    except ValidationError:
+        notification = WebsocketNotification.parse_obj(codec.loads(message.body, message.content_type))
+    except (ValidationError, ValueError):
         logger.exception("Error on parsing message body %s", message.body)
         return
 
     if (ws := ws_connections.get(str(notification.user_id))) is not None:
-        await ws.send(notification.msg_body)
+        msg_body = notification.msg_body
+        # тело забираем из redis, только если пользователь на связи
+        if notification.msg_body_ref is not None:
+            try:
+                msg_body = await blobs.get(notification.msg_body_ref)
+            except RedisError:
+                logger.exception("Error on getting body %s", notification.msg_body_ref)
+                return
+            if msg_body is None:
+                logger.error("Body %s not found for notification %s", notification.msg_body_ref, notification.msg_id)
+                return
+        await ws.send(msg_body)
 
 
 @backoff.on_exception(backoff.expo, AMQPConnectionError, max_time=60, raise_on_giveup=True)
@@ -10,3 +10,4 @@ class WebsocketNotification(BaseModel):
     user_id: UUID
     msg_meta: dict = Field(default_factory=dict)
     msg_body: str
+    msg_body_ref: str | None = None  # ключ тела в redis, если ETL не положил его в сообщение